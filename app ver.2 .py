@@ -2,20 +2,1296 @@
 import streamlit as st          # Webアプリを作るためのフレームワーク
 import pandas as pd             # 表形式データ（DataFrame）を扱うライブラリ。CSV保存に使用
 from datetime import datetime   # 日付・時刻を扱う標準ライブラリ
-from openai import OpenAI       # OpenAIのAPIを利用するためのクラス
+from openai import OpenAI, DefaultHttpxClient, Timeout  # OpenAIのAPIを利用するためのクラス
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError  # 再試行してよいエラー
 import plotly.graph_objects as go  # グラフを描くためのライブラリ
+import httpx  # OpenAIとの通信（接続の使い回しやタイムアウト）の設定に使う
 import json   # JSONデータを扱うためのライブラリ
 import base64 # 画像をテキストデータに変換するためのライブラリ
-
-# セッション状態でデータを保持（アプリがリロードされるまで維持）
-if 'generated_names' not in st.session_state:
-    st.session_state.generated_names = []
+import hashlib      # 入力条件や画像からキャッシュ用のハッシュ値を作る
+import os           # 環境変数から設定を読み込む
+import re           # 入力文字列の区切りを揃える
+import sqlite3      # 生成結果のキャッシュをファイルに保存する
+import time         # キャッシュの有効期限の判定に使う
+import unicodedata  # 全角・半角などの表記ゆれを揃える
+import io           # 画像をメモリ上で読み書きする
+import random       # 再試行の待ち時間をばらつかせる
+import threading    # 複数のスレッドから同時に使う値を守る
+import uuid         # 履歴の持ち主を区別するIDを作る
+import math         # 軽量表示のレーダーチャート（SVG）の頂点の位置を計算する
+import contextvars  # 計測中の操作の情報を、並列処理のスレッドにも引き継ぐ
+from concurrent.futures import ThreadPoolExecutor, as_completed  # 複数のリクエストを並行して送る
+from PIL import Image, ImageOps  # 画像の縮小・変換に使うライブラリ
+from name_scoring import check_kanji_constraints, local_scores  # APIを使わずに計算できる名前の指標・漢字の条件チェック
+from metrics import (  # 処理時間・トークン数・エラーの計測
+    configure_json_log, logger, measure, record_api_call, record_cache, record_error, record_route, record_tokens,
+    start_metrics_server, trace_request,
+)
 
 # タイトル
 st.title("Namers AI　～AI名付け支援ツール～")
 
-# OpenAIのクライアントを初期化
-client = OpenAI()
+# =====================================================================
+# 生成結果のキャッシュ（SQLite）
+# 同じ条件での生成はAPIを呼ばずに保存済みの結果を返す。
+# ファイルに保存するので再起動後も残り、複数のワーカープロセスで共有できる。
+# =====================================================================
+CACHE_DB_PATH = os.environ.get("NAMERS_CACHE_DB", "namers_cache.sqlite3")
+CACHE_TTL_SECONDS = int(os.environ.get("NAMERS_CACHE_TTL", 60 * 60 * 24 * 7))  # 既定は7日で期限切れ
+CACHE_MAX_ENTRIES = int(os.environ.get("NAMERS_CACHE_MAX_ENTRIES", 5000))     # 超えたら最後に使われたのが古い順に削除
+GENERATION_PROMPT_VERSION = 3  # プロンプトを変更したら上げる（古いキャッシュを使わないため）
+EVALUATION_PROMPT_VERSION = 1  # 診断（簡易診断を含む）のプロンプトを変更したら上げる
+
+
+def open_cache_db():
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")  # 複数プロセスからの同時読み書きに強くする
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)")
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    return conn
+
+
+def normalize_text(text):
+    # 全角・半角の違いや前後・連続する空白を揃える
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def normalize_kanji_list(text):
+    # 「翔、愛」「愛,翔」「翔 愛」など区切りや順番が違っても同じ条件として扱う
+    return sorted({part for part in re.split(r"[、,・/\s]+", normalize_text(text)) if part})
+
+
+def make_generation_cache_key(target_type, surname, gender, use_kanji, avoid_kanji, tags, wish, image_digest, variant=0):
+    # variant は「候補をまとめて生成」のときの何回目のリクエストか（温度などが異なるので別々に保存する）
+    conditions = {
+        "version": GENERATION_PROMPT_VERSION,
+        "target_type": target_type,
+        "surname": normalize_text(surname),
+        "gender": gender,
+        "use_kanji": normalize_kanji_list(use_kanji),
+        "avoid_kanji": normalize_kanji_list(avoid_kanji),
+        "tags": sorted(set(tags)),
+        "wish": normalize_text(wish),
+        "image": image_digest,
+        "variant": variant,
+    }
+    canonical = json.dumps(conditions, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def increment_counter(conn, name, amount=1):
+    conn.execute(
+        "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, amount),
+    )
+
+
+def record_counters(**amounts):
+    # キャッシュ以外の集計（漢字の条件の違反数など）も同じファイルに記録して、全プロセスで合計する
+    try:
+        with open_cache_db() as conn:
+            for name, amount in amounts.items():
+                increment_counter(conn, name, amount)
+    except sqlite3.Error:
+        pass
+
+
+def cache_get(key, kind="generation"):
+    # キャッシュがあればその内容を、無い・期限切れならNoneを返す。
+    # kind は何のキャッシュか（ヒット率を生成結果と診断結果で分けて数える。生成結果は "hit"/"miss" のまま）
+    try:
+        with open_cache_db() as conn:
+            row = conn.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > CACHE_TTL_SECONDS:
+                if row is not None:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                increment_counter(conn, "miss" if kind == "generation" else f"{kind}_miss")
+                record_cache("miss", kind)
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            increment_counter(conn, "hit" if kind == "generation" else f"{kind}_hit")
+            record_cache("hit", kind)
+            return row[0]
+    except sqlite3.Error:
+        return None  # キャッシュが使えなくても生成自体は続ける
+
+
+def cache_put(key, content):
+    try:
+        with open_cache_db() as conn:
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, content, now, now),
+            )
+            # 期限切れを削除し、件数の上限を超えた分は最後に使われたのが古い順に削除する
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - CACHE_TTL_SECONDS,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (CACHE_MAX_ENTRIES,),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def read_counters():
+    try:
+        with open_cache_db() as conn:
+            return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    except sqlite3.Error:
+        return {}
+
+# =====================================================================
+# 生成履歴（SQLite）
+# 生成した名前は追記だけのテーブルに保存する。再読み込みしても消えず、
+# 履歴が増えても表示は1ページ分、CSVなどの書き出しはダウンロードされたときだけ行う
+# =====================================================================
+HISTORY_DB_PATH = os.environ.get("NAMERS_HISTORY_DB", "namers_history.sqlite3")
+HISTORY_PAGE_SIZE = 20
+HISTORY_COLUMNS = ["timestamp", "対象", "名前", "総合点", "理由"]
+HISTORY_ORDERS = {"新しい順": "created_at DESC, id DESC", "総合点の高い順": "score DESC, id DESC"}
+
+
+def open_history_db():
+    conn = sqlite3.connect(HISTORY_DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS history ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, created_at TEXT NOT NULL, "
+        "target TEXT NOT NULL, name TEXT NOT NULL, score INTEGER, reason TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_owner_created_at ON history (owner, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_owner_target ON history (owner, target, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_owner_score ON history (owner, score)")
+    return conn
+
+
+def append_history(owner, target, name, score, reason):
+    try:
+        with open_history_db() as conn:
+            conn.execute(
+                "INSERT INTO history (owner, created_at, target, name, score, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                (owner, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), target, name, score, reason),
+            )
+    except sqlite3.Error:
+        pass  # 履歴が保存できなくても名前の表示は続ける
+
+
+def history_filter(owner, keyword="", target=None):
+    # 検索条件から WHERE 句とその値を作る
+    where, params = ["owner = ?"], [owner]
+    if target:
+        where.append("target = ?")
+        params.append(target)
+    if keyword:
+        escaped = keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("(name LIKE ? ESCAPE '\\' OR reason LIKE ? ESCAPE '\\')")
+        params += [f"%{escaped}%", f"%{escaped}%"]
+    return " AND ".join(where), params
+
+
+def count_history(owner, keyword="", target=None):
+    where, params = history_filter(owner, keyword, target)
+    try:
+        with open_history_db() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+    except sqlite3.Error:
+        return 0
+
+
+def query_history(owner, keyword="", target=None, order="新しい順", limit=None, offset=0):
+    # 履歴を表示用の列名（CSVと同じ）の表で返す
+    where, params = history_filter(owner, keyword, target)
+    sql = (
+        "SELECT created_at AS timestamp, target AS 対象, name AS 名前, score AS 総合点, reason AS 理由 "
+        f"FROM history WHERE {where} ORDER BY {HISTORY_ORDERS[order]}"
+    )
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    try:
+        with open_history_db() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+    except sqlite3.Error:
+        return pd.DataFrame(columns=HISTORY_COLUMNS)  # 履歴が読めなくても画面の表示は続ける
+
+
+def export_history_csv(owner):
+    return query_history(owner).to_csv(index=False).encode('utf-8-sig')
+
+
+def export_history_parquet(owner):
+    buffer = io.BytesIO()
+    query_history(owner).to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+# 履歴の持ち主を表すID。URLに入れると、アドレスを共有しただけで履歴まで見られてしまうので、セッションの中だけに持つ。
+# 再読み込みや別の端末で同じ履歴を見たいときは、サイドバーの「引き継ぎコード」（このID）を入力してもらう
+if "uid" in st.query_params:
+    del st.query_params["uid"]  # 以前の版でURLに入れていたIDは使わずに消す（コードとして入力すれば引き継げる）
+if "history_owner" not in st.session_state:
+    st.session_state.history_owner = uuid.uuid4().hex
+history_owner = st.session_state.history_owner
+
+
+def restore_history_owner():
+    # 入力された引き継ぎコードの履歴に切り替える（ボタンのコールバックなので、次の再実行の前に呼ばれる）
+    code = st.session_state.get("history_restore_code", "").strip().lower()
+    if re.fullmatch(r"[0-9a-f]{32}", code):
+        st.session_state.history_owner = code
+        st.session_state.history_restore_code = ""
+    else:
+        st.session_state.history_restore_failed = True
+
+# =====================================================================
+# 計測結果の出力先
+# NAMERS_METRICS_PORT を設定すると、そのポートで Prometheus 形式の /metrics を公開する。
+# 既定ではこのマシンの中（127.0.0.1）からだけ読める。外から収集する場合は NAMERS_METRICS_HOST を設定する（例：0.0.0.0）。
+# NAMERS_METRICS_LOG を設定すると、操作1回ごとの内訳（段階別の時間・API・トークン数・エラー）を
+# 1行1件のJSONで出力する（"-" なら標準エラー出力、それ以外はファイルに追記）。
+# =====================================================================
+METRICS_PORT = os.environ.get("NAMERS_METRICS_PORT")
+METRICS_HOST = os.environ.get("NAMERS_METRICS_HOST", "127.0.0.1")
+METRICS_LOG = os.environ.get("NAMERS_METRICS_LOG")
+
+
+@st.cache_resource
+def start_metrics_exporters():
+    # プロセス全体で1回だけ設定する（再実行のたびにログの出力先やサーバーを増やさない）
+    if METRICS_LOG:
+        configure_json_log(METRICS_LOG)
+    if METRICS_PORT:
+        try:
+            return start_metrics_server(int(METRICS_PORT), METRICS_HOST)
+        except (OSError, ValueError) as e:
+            # ポートが使用中・番号が不正なときは /metrics なしで続ける（計測の失敗でアプリ全体を止めない）
+            record_error("metrics_server", e)
+            logger.warning(json.dumps({
+                "event": "metrics_server_error", "host": METRICS_HOST, "port": METRICS_PORT, "error": f"{type(e).__name__}: {e}",
+            }, ensure_ascii=False))
+    return None
+
+
+start_metrics_exporters()
+
+# =====================================================================
+# OpenAIのクライアントと送信ペースの制御
+# クライアントはプロセス全体で1つだけ作り、接続（HTTP/2・keep-alive）を全ユーザーで使い回す。
+# 送信は「ユーザーごとの同時実行数」と「全体の送信ペース（トークンバケット）」で制限し、
+# 混雑時はエラーにせず順番待ちにする。
+# =====================================================================
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("NAMERS_OPENAI_MAX_CONNECTIONS", 50))
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("NAMERS_OPENAI_TIMEOUT", 90))
+USER_MAX_CONCURRENT_REQUESTS = int(os.environ.get("NAMERS_USER_MAX_CONCURRENT", 4))   # 1人が同時に送れる数
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("NAMERS_RATE_LIMIT_RPM", 300))           # 全体で1分あたりに送れる数
+RATE_LIMIT_BURST = int(os.environ.get("NAMERS_RATE_LIMIT_BURST", 20))                 # 一度にまとめて送れる数
+RATE_LIMIT_MAX_WAIT_SECONDS = 60  # これ以上待たされる場合は「混雑中」として諦める
+
+
+class ServerBusyError(Exception):
+    # 送信ペースの上限に達していて、順番待ちが長すぎるときのエラー
+    pass
+
+
+class TokenBucket:
+    # 一定のペースでトークンが貯まり、1回送るごとに1つ使う。貯まっていなければ貯まるまで待つ
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate_per_second
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+@st.cache_resource
+def get_openai_client():
+    http_client = DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS, keepalive_expiry=60),
+    )
+    # タイムアウトは openai 側の Timeout で渡す（httpx.Timeout は openai の版によって受け付けられない）
+    # 再試行は send_with_retry で送信ペースを守りながら行うので、ライブラリ側の自動再試行は使わない
+    return OpenAI(http_client=http_client, timeout=Timeout(OPENAI_TIMEOUT_SECONDS, connect=10), max_retries=0)
+
+
+@st.cache_resource
+def get_rate_limiter():
+    return TokenBucket(RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST)
+
+
+# OpenAIのクライアントを初期化（全セッションで共有）
+client = get_openai_client()
+rate_limiter = get_rate_limiter()
+
+# ユーザー（セッション）ごとの同時実行数の枠。ワーカースレッドからも使うので変数に取り出しておく
+if 'request_slots' not in st.session_state:
+    st.session_state.request_slots = threading.BoundedSemaphore(USER_MAX_CONCURRENT_REQUESTS)
+user_request_slots = st.session_state.request_slots
+
+# =====================================================================
+# ストリーミング表示
+# JSONを最後まで待たずに、届き終わった名前カードやレポートの項目から順に表示する
+# =====================================================================
+json_decoder = json.JSONDecoder()
+
+
+def stream_completion(template=None, **kwargs):
+    # APIの返答を、届いた文字列から少しずつ返す（受信が終わるまで同時実行数の枠を使う）
+    with user_request_slots:
+        started = time.perf_counter()
+        first_token_seconds = None
+        try:
+            stream = send_with_retry(stream=True, stream_options={"include_usage": True}, **kwargs)
+            for chunk in stream:
+                if chunk.usage:
+                    record_usage(template, chunk.usage)  # 使用量は最後のチャンクにだけ入っている
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_seconds is None:
+                        first_token_seconds = time.perf_counter() - started
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            record_api_call(template, kwargs["model"], time.perf_counter() - started, first_token_seconds, error=type(e).__name__)
+            raise
+        record_api_call(template, kwargs["model"], time.perf_counter() - started, first_token_seconds)
+
+
+def skip_json_separators(text, idx, separators=" \t\r\n"):
+    while idx < len(text) and text[idx] in separators:
+        idx += 1
+    return idx
+
+
+def parse_partial_json(text):
+    # 受信途中のJSONオブジェクトから、値が最後まで届いたトップレベルの項目を取り出す。
+    # 受信途中の配列は、届き終わった要素だけを入れて返す（2つ目の戻り値がその項目名）。
+    fields = {}
+    idx = text.find("{")
+    if idx < 0:
+        return fields, None
+    idx += 1
+    while True:
+        idx = skip_json_separators(text, idx, " \t\r\n,")
+        try:
+            key, idx = json_decoder.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            return fields, None
+        idx = skip_json_separators(text, idx)
+        if idx >= len(text) or text[idx] != ":":
+            return fields, None
+        idx = skip_json_separators(text, idx + 1)
+        try:
+            value, end = json_decoder.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            if text.startswith("[", idx):
+                fields[key] = parse_partial_array(text, idx + 1)
+                return fields, key
+            return fields, None
+        # 数値は後ろに区切り文字が届くまで確定しない（「7」が「78」の途中かもしれない）
+        if not text[end:].strip():
+            return fields, None
+        fields[key] = value
+        idx = end
+
+
+def parse_partial_array(text, idx):
+    items = []
+    while True:
+        idx = skip_json_separators(text, idx, " \t\r\n,")
+        try:
+            item, idx = json_decoder.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            return items
+        if not text[idx:].strip():
+            return items
+        items.append(item)
+
+
+def render_local_scores(local, person=False):
+    # APIを使わずに計算した目安（音の数・画数・読みやすさ・他言語でのリスク）を表示する。
+    # person が True（人の名前）のときは、出生届に使えない漢字も知らせる
+    def show(value):
+        return "—" if value is None else value
+
+    st.caption(
+        f"🧮 機械的な目安：{local['char_count']}文字・{local['mora_count']}音（{'-'.join(local['vowels'])}）・"
+        f"画数 {show(local['strokes'])} ／ 響き {show(local['hibiki'])}・字形 {show(local['jikei'])}・可読 {show(local['kadoku'])}"
+    )
+    if local["unknown_kanji"]:
+        st.caption(f"※「{'、'.join(local['unknown_kanji'])}」は収録外の漢字のため、画数・字形・可読の目安は出していません。")
+    if person and local["unregistrable_kanji"]:
+        st.warning(f"「{'、'.join(local['unregistrable_kanji'])}」は常用漢字・人名用漢字ではないため、人の名前として届け出できません。")
+    for tag in local["tag_mismatches"]:
+        st.caption(f"⚠️「{tag}」の条件と文字数が合っていません。")
+    for word in local["bad_words"]:
+        message = f"**【他言語リスク：{word['risk']}】** {word['language']}で「{word['meaning']}」（{word['word']}）"
+        if word["risk"] == "高":
+            st.error(message)
+        elif word["risk"] == "中":
+            st.warning(message)
+        else:
+            st.caption(f"ℹ️ {message}")
+
+
+# =====================================================================
+# スコアのレーダーチャート
+# 共通の見た目（テンプレート）は1回だけ作り、グラフは点数の組み合わせごとに作り置きして使い回す。
+# 「まとめて比較」では全候補を重ねた1つのグラフだけを送り、「軽量表示」ではPlotlyを使わず小さなSVG画像にする。
+# =====================================================================
+RADAR_LABELS = ['響き', '字形', '独創', '可読', '願い']
+RADAR_KEYS = ["hibiki", "jikei", "doku", "kadoku", "negai"]
+CHART_MODES = {"compare": "まとめて比較（グラフは1つ）", "card": "名前ごとにグラフを表示", "light": "軽量表示（通信量を抑える）"}
+COMPARISON_VISIBLE = 5  # 比較グラフで最初から表示する候補の数（残りは凡例をタップすると表示される）
+
+
+def score_tuple(scores):
+    return tuple(scores.get(key, 50) for key in RADAR_KEYS)
+
+
+@st.cache_resource
+def radar_template():
+    # すべてのレーダーチャートに共通の見た目（プロセス全体で1回だけ作り、コピーして使う）
+    fig = go.Figure()
+    fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 100])), margin=dict(t=20, b=20, l=30, r=30))
+    return fig
+
+
+@st.cache_resource(max_entries=512, show_spinner=False)
+def radar_figure(series, height=250):
+    # series は ((凡例の名前, 点数のタプル), ...)。同じ組み合わせのグラフは作り直さずに使い回す（表示するだけで変更はしない）
+    with measure("plotly_build"):
+        fig = go.Figure(radar_template())
+        theta = RADAR_LABELS + RADAR_LABELS[:1]
+        for i, (label, values) in enumerate(series):
+            fig.add_trace(go.Scatterpolar(
+                r=list(values) + [values[0]], theta=theta, fill='toself', name=label,
+                visible=True if i < COMPARISON_VISIBLE else "legendonly",
+                line_color='#00CC96' if len(series) == 1 else None,
+            ))
+        fig.update_layout(showlegend=len(series) > 1, height=height)
+    return fig
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def radar_svg(values, size=200):
+    # Plotlyを使わない静的なレーダーチャート（1KB程度のSVG）
+    center, radius = size / 2, size / 2 - 28
+
+    def point(i, value):
+        angle = math.pi / 2 - 2 * math.pi * i / len(values)
+        return f"{center + radius * value / 100 * math.cos(angle):.1f},{center - radius * value / 100 * math.sin(angle):.1f}"
+
+    def polygon(points, style):
+        return f'<polygon points="{" ".join(points)}" {style}/>'
+
+    parts = [polygon([point(i, level) for i in range(len(values))], 'fill="none" stroke="#ddd"') for level in (25, 50, 75, 100)]
+    parts.append(polygon([point(i, min(max(v, 0), 100)) for i, v in enumerate(values)], 'fill="#00CC96" fill-opacity="0.4" stroke="#00CC96" stroke-width="2"'))
+    for i, label in enumerate(RADAR_LABELS):
+        x, y = point(i, 122).split(",")
+        parts.append(f'<text x="{x}" y="{y}" font-size="12" text-anchor="middle" dominant-baseline="middle" fill="#666">{label}</text>')
+    return f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">{"".join(parts)}</svg>'
+
+
+def render_comparison_chart(names):
+    # 候補すべてを重ねた比較用のレーダーチャートを1つだけ表示する（総合点の高い順に凡例に並べる）
+    ranked = sorted(names, key=lambda item: item["scores"].get("total", 0), reverse=True)
+    series = tuple((f"{item['name']}（{item['yomi']}）", score_tuple(item["scores"])) for item in ranked)
+    with measure("render"):
+        st.plotly_chart(radar_figure(series, height=350), use_container_width=True)
+
+
+def render_name_card(item, target_type, tags=None, index=0):
+    # 生成された名前1件分のカード（スコアとレーダーチャート）を表示し、履歴に追加する。
+    # index は何件目のカードか（同じ点数の候補が並んでもグラフを区別できるように、キーに使う）
+    name, yomi, reason, scores = item["name"], item["yomi"], item["reason"], item["scores"]
+    s_total = scores.get("total", 80)
+
+    with measure("render"), st.container(border=True):
+        # 「まとめて比較」のときは、カードにはグラフを出さない（カードの上にまとめて1つだけ表示する）
+        col_text, col_graph = st.columns([1.2, 1]) if chart_mode != "compare" else (st.container(), None)
+        with col_text:
+            st.metric(label="🏅 総合評価", value=f"{s_total}点")
+            st.caption("名前（コピーできます👇）")
+            st.code(f"{name} ({yomi})", language=None)
+            st.write(f"**理由:** {reason}")
+        if col_graph is not None:
+            with col_graph:
+                if chart_mode == "light":
+                    st.image(radar_svg(score_tuple(scores)))
+                else:
+                    st.plotly_chart(radar_figure(((name, score_tuple(scores)),)), use_container_width=True, key=f"radar_{index}_{name}_{yomi}")
+        render_local_scores(local_scores(name, yomi, tags), person=target_type == "人間")
+
+    append_history(history_owner, target_type, f"{name} ({yomi})", s_total, reason)
+
+
+# 診断レポートの項目（表示する順番）
+REPORT_SECTIONS = ["overall", "analysis", "global_risk", "personas", "advice", "alternatives"]
+
+
+def render_triage(triage, escalated, threshold):
+    # 簡易診断（gpt-4o-mini）の結果を、詳細レポートより先に仮の点数として表示する
+    with st.container(border=True):
+        col_t1, col_t2 = st.columns([1, 2])
+        with col_t1:
+            st.metric(label="⚡ 簡易診断（仮の点数）", value=f"{triage['score']} / 100")
+        with col_t2:
+            st.write(triage["comment"])
+            if escalated:
+                st.caption(f"基準（{threshold}点）を満たしたので、続けて詳細レポートを作成します。")
+            else:
+                st.caption(f"基準（{threshold}点）に届かなかったため、詳細レポートは作成しませんでした。基準を0点にすると、常に詳細レポートを作成します。")
+
+
+def render_report_section(section, report):
+    # 診断レポートの1項目を表示する
+    if section == "overall":
+        # 1. 総合評価
+        rank = report["overall"]["rank"]
+        score = report["overall"]["score"]
+
+        col_r1, col_r2 = st.columns([1, 2])
+        with col_r1:
+            st.metric(label="🏆 総合スコア", value=f"{score} / 100", delta=f"ランク {rank}", delta_color="normal" if rank in ["S", "A"] else "inverse")
+        with col_r2:
+            st.info(f"**コンサルタント講評:**\n\n{report['overall']['comment']}")
+
+    elif section == "analysis":
+        # 2. 分析結果
+        st.markdown("### 🔍 1. 音韻と視覚の分析")
+        st.write(f"**🗣️ 音韻心理（響きの印象）:** {report['analysis']['phonetic']}")
+        st.write(f"**👁️ 視覚バランス（字形）:** {report['analysis']['visual']}")
+
+    elif section == "global_risk":
+        # 3. リスク・文脈判定
+        st.markdown("### 🌍 2. グローバルリスク・文脈の裏付け")
+        risk = report["global_risk"]["risk_level"]
+        if risk == "低":
+            st.success(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
+        elif risk == "中":
+            st.warning(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
+        else:
+            st.error(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
+
+    elif section == "personas":
+        # 4. ペルソナシミュレーション
+        st.markdown("### 👥 3. ターゲット層別 受容度シミュレーション")
+        for p in report["personas"]:
+            st.markdown(f"- **{p['target']}:** {p['impression']}")
+
+    elif section == "advice":
+        # 5. プロのアドバイス
+        st.markdown("### 💡 4. プロフェッショナル・アドバイス")
+        st.write(report["advice"])
+
+    elif section == "alternatives":
+        # 6. 代替案
+        with st.expander("✨ コンサルタントからの代替案（微調整バージョン）を見る"):
+            for alt in report["alternatives"]:
+                st.code(f"{alt['name']} ({alt['yomi']})", language=None)
+                st.write(f"**理由:** {alt['reason']}")
+                st.markdown("---")
+
+# =====================================================================
+# 画像の前処理
+# そのまま送るとデータが大きく、アップロードにも画像トークンにも無駄が多いので、
+# 長辺を縮小し、EXIF（撮影場所などの情報）を取り除いたJPEGに変換してから送る
+# =====================================================================
+IMAGE_MAX_EDGE = 1024     # 長辺の最大ピクセル数
+IMAGE_JPEG_QUALITY = 85   # 名前のイメージを掴むには十分な画質
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def preprocess_image(image_digest, _image_bytes):
+    # 画像の内容のハッシュ値をキーにキャッシュするので、再実行のたびに変換し直さない
+    with Image.open(io.BytesIO(_image_bytes)) as img:
+        img = ImageOps.exif_transpose(img)  # 回転情報を画像に反映してからEXIFを捨てる
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        if img.mode in ("RGBA", "LA", "P"):
+            # 透過部分は白背景に合成する（JPEGは透過を扱えないため）
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    encoded_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return f"data:image/jpeg;base64,{encoded_image}"
+
+# =====================================================================
+# プロンプト
+# 毎回同じ指示（文字種のルール・採点基準）はシステムプロンプトとして最初に1回だけ作り、
+# リクエストごとに変わる入力だけをユーザーメッセージに入れる。
+# 先頭が毎回同じになるので、OpenAI側のプロンプトキャッシュが効き、入力トークンの料金と待ち時間が減る。
+# 出力の形はプロンプトの文章ではなく JSON スキーマ（Structured Outputs）で指定する。
+# =====================================================================
+GENERATION_SYSTEM_PROMPT = """あなたはプロの命名アドバイザーです。
+ユーザーが示す条件に基づいて、最適な名前を指定された数だけ（指定がなければ3つ）提案してください。
+※「雰囲気タグ」と「具体的な願い」の両方を考慮して、イメージに合う名前を考案してください。
+※画像が提供されている場合は、その視覚的イメージも反映してください。
+
+【最重要：名前の言語・文字種のルール】
+以下の優先順位（1が最強）で名前の雰囲気と文字種を決定してください。
+
+1. **「洋風」「洋風の響き」タグ、または「外国風」の指定がある場合（最優先）：**
+   ・苗字の有無に関わらず、**西洋的な響きを持つ名前**（例：アリス、レオ、エマ、アーサーなど）を提案してください。
+   ・表記は**「カタカナ」を基本**としますが、ユーザーが「使いたい漢字」を指定している場合のみ「当て字」を使ってください。
+
+2. 特定の国籍指定（「中国風」「韓国風」など）がある場合：
+   ・その文化圏に合った名前と表記（中国・韓国なら漢字、その他はカタカナ）で提案してください。
+
+3. 上記の指定がない場合（デフォルト）：
+   ・苗字が「漢字」または「苗字なし」の場合：**日本人の名前（漢字・ひらがな）**を提案。
+   ・苗字が「カタカナ」の場合：カタカナの名前を提案。
+   ・対象が「ファンタジー」「キャラクター」の場合：世界観に合わせて自由選択。
+
+【重要：評価システム】
+以下の5項目（各100点満点）と、「総合得点（100点満点）」を厳密に採点してください。
+（響き=hibiki、字形=jikei、独創=doku、可読=kadoku、願い=negai）
+※「総合得点」（total）は名前としての全体のバランス・完成度を加味してください。全体的に厳しめに採点してください。
+※「reason」には名前の語源・本来の意味を明記し、願いをどう叶えるか解説してください。"""
+
+EVAL_SYSTEM_PROMPT = """あなたは世界トップクラスのネーミングコンサルタント・言語学者です。
+ユーザーが考案した名前を、プロの視点で多角的かつ厳密に診断してください。
+・overall：0〜100の総合点、S/A/B/Cのランク、全体的な講評（2〜3文でプロ目線の鋭い評価）
+・analysis：phonetic は音韻心理学的な分析（母音や子音の響きが与える印象）、visual は視覚的バランス・字形の印象（漢字や文字の並びの美しさ）
+・global_risk：英語、中国語、その他の言語圏でネガティブな意味（スラング等）を持たないか、または特定の文化圏での文脈・ルーツに関する解説と、低/中/高のリスク
+・personas：「若年層(10-20代)」「ビジネス層(30-50代)」のそれぞれがどのような印象を抱くか
+・advice：さらに名前を良くするための具体的な改善アドバイス
+・alternatives：微調整した代替案を2つ（改善理由つき）"""
+
+TRIAGE_SYSTEM_PROMPT = """あなたはネーミングの審査員です。
+ユーザーが考案した名前を短時間で採点し、詳細な診断に進む価値があるかを判断してください。
+・score：響き・字形・読みやすさ・願いとの合致・他言語でのリスクを踏まえた0〜100の総合点（全体的に厳しめに採点してください）
+・comment：点数の理由を1〜2文で"""
+
+
+def json_schema_format(name, properties):
+    # Structured Outputs（strict）用の response_format を作る。すべての項目を必須にし、余計な項目は許さない
+    def strict_object(props):
+        return {"type": "object", "properties": props, "required": list(props), "additionalProperties": False}
+
+    def convert(schema):
+        if schema.get("type") == "object":
+            return strict_object({key: convert(value) for key, value in schema["properties"].items()})
+        if schema.get("type") == "array":
+            return {**schema, "items": convert(schema["items"])}
+        return schema
+
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": convert({"type": "object", "properties": properties})}}
+
+
+SCORE = {"type": "integer", "description": "0〜100"}
+GENERATION_RESPONSE_FORMAT = json_schema_format("name_proposals", {
+    "names": {"type": "array", "items": {"type": "object", "properties": {
+        "name": {"type": "string", "description": "名前の表記"},
+        "yomi": {"type": "string", "description": "読み仮名"},
+        "scores": {"type": "object", "properties": {
+            "total": SCORE, "hibiki": SCORE, "jikei": SCORE, "doku": SCORE, "kadoku": SCORE, "negai": SCORE,
+        }},
+        "reason": {"type": "string"},
+    }}},
+})
+# 項目の順番は REPORT_SECTIONS と同じにする（ストリーミングで上から順に表示できるように）
+EVAL_RESPONSE_FORMAT = json_schema_format("name_report", {
+    "overall": {"type": "object", "properties": {
+        "score": SCORE, "rank": {"type": "string", "enum": ["S", "A", "B", "C"]}, "comment": {"type": "string"},
+    }},
+    "analysis": {"type": "object", "properties": {"phonetic": {"type": "string"}, "visual": {"type": "string"}}},
+    "global_risk": {"type": "object", "properties": {
+        "risk_level": {"type": "string", "enum": ["低", "中", "高"]}, "detail": {"type": "string"},
+    }},
+    "personas": {"type": "array", "items": {"type": "object", "properties": {
+        "target": {"type": "string"}, "impression": {"type": "string"},
+    }}},
+    "advice": {"type": "string"},
+    "alternatives": {"type": "array", "items": {"type": "object", "properties": {
+        "name": {"type": "string"}, "yomi": {"type": "string"}, "reason": {"type": "string"},
+    }}},
+})
+TRIAGE_RESPONSE_FORMAT = json_schema_format("name_triage", {"score": SCORE, "comment": {"type": "string"}})
+
+
+def build_generation_messages(target_type, surname, gender, use_kanji, avoid_kanji, tags, wish, image_data_url=None):
+    surname_instruction = f"苗字は「{surname}」です。" if surname else "苗字はありません。"
+    prompt = f"""【入力情報】
+・苗字：{surname_instruction}
+・対象：{target_type}
+・性別：{gender}
+・使いたい漢字：{use_kanji}
+・避けたい漢字：{avoid_kanji}
+【重要：イメージ・雰囲気】
+・選択された雰囲気タグ：{", ".join(tags) if tags else "指定なし"}
+・具体的な願い：{wish}
+【提案する数】{GENERATION_BATCH_SIZE}つ"""
+    content = prompt
+    if image_data_url:
+        content = [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url}}]
+    return [{"role": "system", "content": GENERATION_SYSTEM_PROMPT}, {"role": "user", "content": content}]
+
+
+def build_eval_messages(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, system_prompt=EVAL_SYSTEM_PROMPT):
+    prompt = f"""【診断対象】
+・対象：{eval_target}
+・苗字：{eval_surname}
+・名前：{eval_name}
+・読み：{eval_yomi}
+・コンセプト/願い：{eval_wish}"""
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+
+
+# =====================================================================
+# トークン使用量の記録（テンプレートごと）
+# 返答の usage を集計して、1回あたりの入力・出力トークンとプロンプトキャッシュの効き具合を確認できるようにする
+# =====================================================================
+PROMPT_TEMPLATES = {
+    "generation": "名前の生成", "generation_repair": "漢字条件の差し替え", "generation_salvage": "壊れた候補の補充",
+    "generation_top_up": "足りない候補の追加",
+    "evaluation": "プレミアム診断", "evaluation_salvage": "欠けた項目の補充", "evaluation_triage": "簡易診断",
+}
+
+
+def record_usage(template, usage):
+    if template is None or usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    tokens = {
+        "prompt": usage.prompt_tokens or 0,
+        "cached": (getattr(details, "cached_tokens", 0) or 0) if details else 0,
+        "completion": usage.completion_tokens or 0,
+    }
+    record_counters(**{f"calls:{template}": 1}, **{f"{kind}_tokens:{template}": amount for kind, amount in tokens.items()})
+    record_tokens(template, **tokens)
+
+
+# =====================================================================
+# API呼び出しの再試行
+# 混雑（429）や一時的な通信エラーのときは、少し待ってから送り直す
+# =====================================================================
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+API_MAX_ATTEMPTS = 5
+
+
+def create_with_retry(template=None, **kwargs):
+    # APIを呼び出す共通の入口（ユーザーごとの同時実行数の枠が空くまで待つ）
+    with user_request_slots:
+        started = time.perf_counter()
+        try:
+            response = send_with_retry(**kwargs)
+        except Exception as e:
+            record_api_call(template, kwargs["model"], time.perf_counter() - started, error=type(e).__name__)
+            raise
+        record_api_call(template, kwargs["model"], time.perf_counter() - started)
+    record_usage(template, response.usage)
+    return response
+
+
+def send_with_retry(**kwargs):
+    for attempt in range(API_MAX_ATTEMPTS):
+        if not rate_limiter.acquire(RATE_LIMIT_MAX_WAIT_SECONDS):
+            raise ServerBusyError("ただいま混み合っています")
+        try:
+            return client.chat.completions.create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            record_error("api_retry", e)
+            if attempt == API_MAX_ATTEMPTS - 1:
+                raise
+            # サーバーが待ち時間（Retry-After）を指定していればそれに従い、なければ指数的に待ち時間を延ばす
+            response = getattr(e, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            try:
+                wait = float(retry_after)
+            except (TypeError, ValueError):
+                wait = min(30, 2 ** attempt) + random.uniform(0, 1)
+            time.sleep(wait)
+
+
+# =====================================================================
+# 返答の検証と、欠けた部分だけの作り直し
+# 返答の一部が壊れていたり途中で切れていたりしても、形式どおりの候補・項目はそのまま使い、
+# 足りない分だけを短い追加の指示で頼み直す（全体を作り直すより、トークンも待ち時間も少なくて済む）
+# =====================================================================
+NAME_ITEM_SCHEMA = GENERATION_RESPONSE_FORMAT["json_schema"]["schema"]["properties"]["names"]["items"]
+REPORT_SECTION_SCHEMAS = EVAL_RESPONSE_FORMAT["json_schema"]["schema"]["properties"]
+
+
+def matches_schema(value, schema):
+    # json_schema_format で作ったスキーマに合っているか。文字列は空でないこと、整数（点数）は0〜100であることも確かめる
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    kind = schema.get("type")
+    if kind == "object":
+        return isinstance(value, dict) and all(key in value and matches_schema(value[key], sub) for key, sub in schema["properties"].items())
+    if kind == "array":
+        return isinstance(value, list) and all(matches_schema(item, schema["items"]) for item in value)
+    if kind == "string":
+        return isinstance(value, str) and value.strip() != ""
+    if kind == "integer":
+        return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 100
+    return True
+
+
+def load_json_fields(content):
+    # トップレベルの項目を取り出す。JSONとして壊れていても、壊れた箇所より前に届き終わった項目は残す。
+    # 2つ目の戻り値は、途中で切れた配列の項目名（届き終わった要素だけが入っている）
+    try:
+        value = json.loads(content)
+        return (value if isinstance(value, dict) else {}), None
+    except json.JSONDecodeError:
+        return parse_partial_json(content)
+
+
+def parse_name_proposals(content):
+    # 形式どおりの名前の候補と、1回の生成でもらえるはずの数に足りない件数を返す
+    with measure("json_parse"):
+        fields, _ = load_json_fields(content)
+        items = fields.get("names")
+        names = [item for item in items if matches_schema(item, NAME_ITEM_SCHEMA)] if isinstance(items, list) else []
+    return names, max(0, GENERATION_BATCH_SIZE - len(names))
+
+
+def parse_report(content, sections=REPORT_SECTIONS):
+    # 形式どおりの項目だけを残したレポートと、欠けた・壊れた項目の一覧を返す（途中で切れた配列の項目は欠けた扱い）
+    with measure("json_parse"):
+        fields, pending = load_json_fields(content)
+        report = {
+            section: fields[section] for section in sections
+            if section in fields and section != pending and matches_schema(fields[section], REPORT_SECTION_SCHEMAS[section])
+        }
+    return report, [section for section in sections if section not in report]
+
+
+def request_follow_up_names(messages, follow_up, template):
+    # 最初の会話に短い追加の指示を付けて、名前の候補をもらい直す
+    response = create_with_retry(
+        template=template, model="gpt-4o-mini",
+        messages=messages + [{"role": "user", "content": follow_up}], response_format=GENERATION_RESPONSE_FORMAT
+    )
+    names, _ = parse_name_proposals(response.choices[0].message.content)
+    return names
+
+
+def fill_missing_names(names, messages, shortfall):
+    # 壊れていた・届かなかった候補の数だけ追加で提案してもらう。候補の一覧と、追加できた件数を返す
+    if not shortfall:
+        return names, 0
+    known_names = [item["name"] for item in names]
+    follow_up = f"提案する数以外は最初の条件のまま、名前を{shortfall}つだけ提案してください。"
+    if known_names:
+        follow_up += "\n次の名前はすでに提案済みなので除いてください：" + "、".join(known_names)
+    try:
+        extra = request_follow_up_names(messages, follow_up, "generation_salvage")
+    except Exception as e:
+        record_error("generation_salvage", e)  # 追加できなくても、届いた候補だけで表示を続ける
+        return names, 0
+    extra = [item for item in extra if item["name"] not in known_names][:shortfall]
+    return names + extra, len(extra)
+
+
+def request_missing_sections(messages, report, missing):
+    # 届いた項目を前の返答として渡し、欠けた項目だけを同じ形式で出力してもらう
+    follow_up = "前の返答では次の項目が欠けていたか、形式が正しくありませんでした：" + "、".join(missing) + "。\nこれらの項目だけを出力してください。"
+    response = create_with_retry(
+        template="evaluation_salvage", model="gpt-4o",
+        messages=messages + [
+            {"role": "assistant", "content": json.dumps(report, ensure_ascii=False)},
+            {"role": "user", "content": follow_up},
+        ],
+        response_format=json_schema_format("name_report_sections", {section: REPORT_SECTION_SCHEMAS[section] for section in missing}),
+    )
+    sections, _ = parse_report(response.choices[0].message.content, missing)
+    return sections
+
+
+def complete_report(messages, content):
+    # 形式どおりの項目はそのまま使い、欠けた・壊れた項目だけを追加で頼む。レポートと、最後まで揃わなかった項目の一覧を返す
+    report, missing = parse_report(content)
+    if missing:
+        try:
+            report.update(request_missing_sections(messages, report, missing))
+        except Exception as e:
+            record_error("evaluation_salvage", e)  # 揃わなかった項目は表示しないだけにして、届いた項目は見せる
+        missing = [section for section in REPORT_SECTIONS if section not in report]
+    return report, missing
+
+
+# =====================================================================
+# 候補をまとめて生成
+# 温度やシードを変えた生成リクエストを並行して送り、結果をまとめて重複を除き、総合点順に並べる
+# =====================================================================
+GENERATION_BATCH_SIZE = 3  # 1回のリクエストで提案してもらう名前の数（ユーザーメッセージの「提案する数」に入る）
+GENERATION_TEMPERATURES = [1.0, 0.8, 1.2, 0.9, 1.1]  # 1回目は通常の生成と同じ設定にしてキャッシュを共有する
+
+
+def request_generation(messages, cache_key, variant, force_fresh, use_list, avoid_list):
+    # 生成1回分の (候補, 補充した件数, 条件に合わなかった件数, 差し替えた件数) を返す（finish_generation を参照）。並列生成のワーカースレッドから呼ばれる
+    content = None if force_fresh else cache_get(cache_key)
+    from_cache = content is not None
+    if content is None:
+        options = {}
+        if variant:
+            options = {"temperature": GENERATION_TEMPERATURES[variant % len(GENERATION_TEMPERATURES)]}
+            if not force_fresh:
+                options["seed"] = variant  # 「新しく考えてもらう」ときは seed を固定せず、毎回違う候補が出るようにする
+        response = create_with_retry(
+            template="generation", model="gpt-4o-mini", messages=messages, response_format=GENERATION_RESPONSE_FORMAT, **options
+        )
+        content = response.choices[0].message.content
+    return finish_generation(content, messages, cache_key, from_cache, use_list, avoid_list)
+
+
+def generate_names_parallel(messages, cache_keys, force_fresh, use_list, avoid_list):
+    # 成功したリクエストの (候補, 補充した件数, 条件に合わなかった件数, 差し替えた件数) の一覧と、失敗したリクエストの数を返す
+    results, errors = [], []
+    with ThreadPoolExecutor(max_workers=len(cache_keys)) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, request_generation, messages, cache_key, variant, force_fresh, use_list, avoid_list
+            )
+            for variant, cache_key in enumerate(cache_keys)
+        ]
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                record_error("generation_parallel", e)
+                errors.append(e)
+    if not results:
+        raise errors[0]
+    return results, len(errors)
+
+
+def normalize_yomi(yomi):
+    # カタカナをひらがなに揃える（「ヒナ」と「ひな」を同じ読みとして扱う）
+    yomi = normalize_text(yomi).replace(" ", "")
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in yomi)
+
+
+def merge_name_candidates(names, tags):
+    # 名前と読みが同じ候補や、機械的な判定で明らかに条件に合わない候補
+    # （文字数タグと合わない・他言語でリスクが高い）を除いて、総合点の高い順に並べる
+    seen, merged = set(), []
+    duplicates = rejected = 0
+    for item in names:
+        key = (normalize_text(item["name"]).replace(" ", ""), normalize_yomi(item["yomi"]))
+        if key in seen:
+            duplicates += 1
+            continue
+        local = local_scores(item["name"], item["yomi"], tags)
+        if local["tag_mismatches"] or local["risk_level"] == "高":
+            rejected += 1
+            continue
+        seen.add(key)
+        merged.append(item)
+    merged.sort(key=lambda item: item["scores"].get("total", 0), reverse=True)
+    return merged, duplicates, rejected
+
+
+def top_up_candidates(candidates, proposed, messages, cache_key, force_fresh, tags, use_list, avoid_list, candidate_count):
+    # 重複・条件外を除いて候補が足りなくなったときに、提案済みの名前を除く追加の指示を1回だけ送って補う。
+    # 補った分も他の候補と同じように保存しておき、次に同じ条件で使うときはAPIを呼ばずに済ませる。候補の一覧と、補えた件数を返す
+    shortfall = candidate_count - len(candidates)
+    if shortfall <= 0:
+        return candidates, 0
+    content = None if force_fresh else cache_get(cache_key)
+    if content is None:
+        known_names = [item["name"] for item in proposed]
+        follow_up = (
+            f"提案する数以外は最初の条件のまま、名前を{shortfall}つだけ提案してください。\n"
+            "次の名前はすでに提案済みなので除いてください：" + "、".join(known_names)
+        )
+        try:
+            extra = request_follow_up_names(messages, follow_up, "generation_top_up")
+        except Exception as e:
+            record_error("generation_top_up", e)  # 補えなくても、揃った候補だけで表示を続ける
+            return candidates, 0
+        extra, _ = split_kanji_violations(extra, use_list, avoid_list)
+        if extra:
+            cache_put(cache_key, json.dumps({"names": extra}, ensure_ascii=False))
+    else:
+        extra, _ = parse_name_proposals(content)
+    merged, _, _ = merge_name_candidates(candidates + extra, tags)
+    merged = merged[:candidate_count]
+    return merged, len(merged) - len(candidates)
+
+
+# =====================================================================
+# 漢字の条件チェックと差し替え
+# 「使いたい漢字」「避けたい漢字」を守れていない候補だけを、短い追加の指示で作り直してもらう
+# （全体を生成し直すよりトークンも待ち時間も少なくて済む）
+# =====================================================================
+KANJI_REPAIR_MAX_ROUNDS = 2  # 差し替えを頼む回数の上限
+
+
+def split_kanji_violations(names, use_list, avoid_list, record=True):
+    # 条件どおりの候補と、違反した候補（名前と理由の組）に分ける
+    valid, violators = [], []
+    for item in names:
+        problems = check_kanji_constraints(item["name"], item["yomi"], use_list, avoid_list)
+        if problems:
+            violators.append((item["name"], "・".join(problems)))
+        else:
+            valid.append(item)
+    if record and (use_list or avoid_list):
+        record_counters(kanji_checked=len(names), kanji_violations=len(violators))
+    return valid, violators
+
+
+def request_replacement_names(messages, violators, known_names, count):
+    follow_up = (
+        "次の名前は漢字の条件を守れていません：" + "、".join(f"{name}（{reason}）" for name, reason in violators) + "。\n"
+        f"提案する数以外は最初の条件のまま、これらの代わりになる名前を{count}つだけ提案してください。"
+        "「避けたい漢字」はその旧字体・異体字も含めて使わず、「使いたい漢字」が指定されている場合はそのいずれかを必ず使ってください。\n"
+        "次の名前はすでに提案済みなので除いてください：" + "、".join(known_names)
+    )
+    return request_follow_up_names(messages, follow_up, "generation_repair")
+
+
+def repair_kanji_violations(names, messages, use_list, avoid_list, record=True):
+    # 条件どおりの候補（元の順番のまま、最後に差し替え分を追加）と、条件に合わなかった件数・実際に差し替えた件数を返す。
+    # 差し替え候補が見つからなかった分は、条件に合わない候補を表示しないようにそのまま除く
+    valid, violators = split_kanji_violations(names, use_list, avoid_list, record)
+    violation_count = remaining = len(violators)
+    known_names = [item["name"] for item in names]
+    for _ in range(KANJI_REPAIR_MAX_ROUNDS):
+        if not remaining:
+            break
+        replacements = request_replacement_names(messages, violators, known_names, remaining)
+        replacements = [item for item in replacements if item["name"] not in known_names]  # 提案済みの名前の繰り返しは除く
+        known_names += [item["name"] for item in replacements]
+        replaced, new_violators = split_kanji_violations(replacements, use_list, avoid_list)
+        replaced = replaced[:remaining]  # 頼んだ数より多く返ってきても、足りない分だけを使う
+        valid += replaced
+        remaining -= len(replaced)
+        violators = new_violators or violators
+    return valid, violation_count, violation_count - remaining
+
+
+def finish_generation(content, messages, cache_key, from_cache, use_list, avoid_list):
+    # 生成1回分の返答を検証し、壊れた候補の補充と漢字の条件の差し替えを済ませて
+    # (候補, 補充した件数, 条件に合わなかった件数, 差し替えた件数) を返す。
+    # 候補が揃ったときだけ結果をキャッシュに保存する（次に同じ条件で使うときは、補充・差し替えをせずにそのまま表示できる）
+    names, shortfall = parse_name_proposals(content)
+    names, salvaged_count = fill_missing_names(names, messages, shortfall)
+    names, violation_count, replaced_count = repair_kanji_violations(names, messages, use_list, avoid_list, record=not from_cache)
+    if len(names) >= GENERATION_BATCH_SIZE and (not from_cache or salvaged_count or violation_count):
+        cache_put(cache_key, json.dumps({"names": names}, ensure_ascii=False))
+    return names, salvaged_count, violation_count, replaced_count
+
+
+# =====================================================================
+# プレミアム診断の振り分け
+# 以前に同じ条件で診断していればその結果を使い、そうでなければまず gpt-4o-mini で仮の点数を出す。
+# 仮の点数が基準に届いた名前だけ gpt-4o の詳細診断に進める（振り分け先と費用の目安を記録する）
+# =====================================================================
+ESCALATION_THRESHOLD = int(os.environ.get("NAMERS_ESCALATION_THRESHOLD", 60))  # 簡易診断がこの点数以上なら詳細診断に進む
+EVALUATION_ROUTES = {"cache": "保存済み", "triage": "簡易", "full": "詳細"}
+MODEL_PRICES = {"gpt-4o": (2.50, 10.00), "gpt-4o-mini": (0.15, 0.60)}  # 100万トークンあたりの料金（ドル、入力・出力）
+# まだ呼び出しの実績がないときに使う、1回あたりのトークン数の目安（入力, 出力）
+DEFAULT_CALL_TOKENS = {"evaluation": (700, 900), "evaluation_triage": (400, 80)}
+
+
+def make_evaluation_cache_key(kind, eval_target, eval_surname, eval_name, eval_yomi, eval_wish):
+    # kind は "report"（詳細診断）か "triage"（簡易診断）
+    conditions = {
+        "kind": kind,
+        "version": EVALUATION_PROMPT_VERSION,
+        "target": eval_target,
+        "surname": normalize_text(eval_surname),
+        "name": normalize_text(eval_name),
+        "yomi": normalize_yomi(eval_yomi),
+        "wish": normalize_text(eval_wish),
+    }
+    canonical = json.dumps(conditions, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def estimated_call_cost(template, model, counters):
+    # これまでの1回あたりの平均トークン数から、呼び出し1回分の料金の目安を計算する
+    calls = counters.get(f"calls:{template}", 0)
+    if calls:
+        prompt, completion = counters.get(f"prompt_tokens:{template}", 0) / calls, counters.get(f"completion_tokens:{template}", 0) / calls
+    else:
+        prompt, completion = DEFAULT_CALL_TOKENS[template]
+    input_price, output_price = MODEL_PRICES[model]
+    return (prompt * input_price + completion * output_price) / 1_000_000
+
+
+def log_evaluation_route(route, triage_called, **details):
+    # 振り分け先の回数を数え、常に詳細診断した場合と比べた費用の目安はログと /metrics にだけ記録する（画面には出さない）
+    counters = read_counters()
+    baseline = estimated_call_cost("evaluation", "gpt-4o", counters)
+    actual = estimated_call_cost("evaluation_triage", "gpt-4o-mini", counters) if triage_called else 0.0
+    if route == "full":
+        actual += baseline
+    record_counters(**{f"route:{route}": 1})
+    record_route(route, baseline, actual, **details)
+
+
+def load_cached_report(cache_key):
+    content = cache_get(cache_key, "evaluation_report")
+    if content is None:
+        return None
+    report, missing = parse_report(content)
+    return None if missing else report
+
+
+def triage_name(eval_target, eval_surname, eval_name, eval_yomi, eval_wish):
+    # gpt-4o-mini で仮の点数と短いコメントだけを出してもらう。(結果, APIを呼んだか) を返す
+    cache_key = make_evaluation_cache_key("triage", eval_target, eval_surname, eval_name, eval_yomi, eval_wish)
+    content = cache_get(cache_key, "evaluation_triage")
+    if content is not None:
+        return json.loads(content), False
+    messages = build_eval_messages(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, TRIAGE_SYSTEM_PROMPT)
+    response = create_with_retry(
+        template="evaluation_triage", model="gpt-4o-mini", messages=messages, response_format=TRIAGE_RESPONSE_FORMAT
+    )
+    with measure("json_parse"):
+        fields, _ = load_json_fields(response.choices[0].message.content)
+    if not matches_schema(fields, TRIAGE_RESPONSE_FORMAT["json_schema"]["schema"]):
+        raise ValueError("簡易診断の結果を読み取れませんでした")
+    triage = {"score": fields["score"], "comment": fields["comment"]}
+    cache_put(cache_key, json.dumps(triage, ensure_ascii=False))
+    return triage, True
+
+
+def plan_evaluation(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, threshold):
+    # どこまで診断するかを決めて (振り分け先, 保存済みのレポート, 簡易診断の結果) を返す。振り分け先は
+    # "cache"（以前の同じ診断を使う）・"triage"（簡易診断で終える）・"full"（詳細診断に進む）のいずれか
+    report = load_cached_report(make_evaluation_cache_key("report", eval_target, eval_surname, eval_name, eval_yomi, eval_wish))
+    if report is not None:
+        log_evaluation_route("cache", False, threshold=threshold)
+        return "cache", report, None
+    if threshold <= 0:
+        log_evaluation_route("full", False, threshold=threshold)  # 基準が0点なら必ず詳細診断するので、簡易診断は省く
+        return "full", None, None
+    try:
+        triage, triage_called = triage_name(eval_target, eval_surname, eval_name, eval_yomi, eval_wish)
+    except Exception as e:
+        record_error("evaluation_triage", e)  # 簡易診断に失敗したときは、そのまま詳細診断に進む
+        log_evaluation_route("full", True, threshold=threshold, triage_score=None)
+        return "full", None, None
+    route = "full" if triage["score"] >= threshold else "triage"
+    log_evaluation_route(route, triage_called, threshold=threshold, triage_score=triage["score"])
+    return route, None, triage
+
+
+def save_report(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, report):
+    # すべての項目が揃った詳細診断だけを保存して、次に同じ条件で診断されたときに使う
+    cache_put(
+        make_evaluation_cache_key("report", eval_target, eval_surname, eval_name, eval_yomi, eval_wish),
+        json.dumps(report, ensure_ascii=False),
+    )
+
+
+# =====================================================================
+# プレミアム診断
+# =====================================================================
+def evaluate_name(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, threshold=ESCALATION_THRESHOLD):
+    # 名前1件を振り分けて診断し、(振り分け先, レポート, 簡易診断の結果) を返す（簡易診断で終えたときのレポートは None）。
+    # 一括診断のワーカースレッドから呼ばれる
+    route, report, triage = plan_evaluation(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, threshold)
+    if route != "full":
+        return route, report, triage
+    messages = build_eval_messages(eval_target, eval_surname, eval_name, eval_yomi, eval_wish)
+    response = create_with_retry(template="evaluation", model="gpt-4o", messages=messages, response_format=EVAL_RESPONSE_FORMAT)
+    report, missing = complete_report(messages, response.choices[0].message.content)
+    if missing:
+        raise ValueError("レポートの項目を取得できませんでした：" + "、".join(missing))
+    save_report(eval_target, eval_surname, eval_name, eval_yomi, eval_wish, report)
+    return route, report, triage
+
+
+BATCH_MAX_ROWS = 500
+# 一括診断ファイルの列名（日本語の見出しでも受け付ける）
+BATCH_COLUMNS = {"surname": "苗字", "name": "名前", "yomi": "読み", "target": "対象", "wish": "願い"}
+
+
+def load_batch_rows(batch_file, default_target):
+    # 診断できる行の一覧と、上限を超えたため診断しない行の数を返す。
+    # 読み込めないファイル（壊れたJSONL・空のCSV・文字コードの違いなど）は pandas が ValueError の仲間を送出する
+    if batch_file.name.lower().endswith(".jsonl"):
+        df = pd.read_json(batch_file, lines=True, dtype=str)
+    else:
+        df = pd.read_csv(batch_file, dtype=str)
+    df = df.rename(columns={ja: en for en, ja in BATCH_COLUMNS.items()})
+    for column in BATCH_COLUMNS:
+        if column not in df.columns:
+            df[column] = ""
+    df = df[list(BATCH_COLUMNS)].fillna("").apply(lambda col: col.str.strip())
+    df.loc[df["target"] == "", "target"] = default_target
+    # 名前と読みがない行は診断できないので除く
+    df = df[(df["name"] != "") & (df["yomi"] != "")]
+    return df.head(BATCH_MAX_ROWS).to_dict("records"), max(0, len(df) - BATCH_MAX_ROWS)
+
+
+def run_batch_evaluation(rows, max_workers, on_progress, threshold=ESCALATION_THRESHOLD):
+    # 複数の名前を並行して診断し、総合点の高い順に並べた表を返す（簡易診断で終えた名前は仮の点数とコメントだけ）
+    results = [None] * len(rows)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run, evaluate_name,
+                row["target"], row["surname"], row["name"], row["yomi"], row["wish"], threshold
+            ): i
+            for i, row in enumerate(rows)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            row = rows[i]
+            result = {"苗字": row["surname"], "名前": row["name"], "読み": row["yomi"], "対象": row["target"]}
+            try:
+                route, report, triage = future.result()
+                if report is None:
+                    result.update({"総合点": triage["score"], "ランク": "", "リスク": "", "アドバイス": triage["comment"]})
+                else:
+                    result.update({
+                        "総合点": report["overall"]["score"], "ランク": report["overall"]["rank"],
+                        "リスク": report["global_risk"]["risk_level"], "アドバイス": report["advice"]
+                    })
+                result.update({"診断": EVALUATION_ROUTES[route], "エラー": ""})
+            except Exception as e:
+                record_error("batch_evaluation_row", e)
+                result.update({"総合点": None, "ランク": "", "リスク": "", "アドバイス": "", "診断": "", "エラー": str(e)})
+            results[i] = result
+            on_progress(done, len(rows))
+
+    df = pd.DataFrame(results)
+    df["総合点"] = pd.to_numeric(df["総合点"], errors="coerce")
+    df = df.sort_values("総合点", ascending=False, na_position="last").reset_index(drop=True)
+    df.insert(0, "順位", range(1, len(df) + 1))
+    return df
+
+# 表示設定（両方のタブで共通）
+st.sidebar.markdown("### 表示設定")
+stream_mode = st.sidebar.toggle("⚡ 届いた結果から順に表示する", value=True, help="AIの返答を最後まで待たずに、完成した名前やレポートの項目から表示します。")
+chart_mode = st.sidebar.radio(
+    "スコアのグラフ", list(CHART_MODES), format_func=CHART_MODES.get,
+    help="「まとめて比較」は全候補を重ねたグラフを1つだけ表示します。通信が遅いときは「軽量表示」がおすすめです。"
+)
 
 # =====================================================================
 # タブの作成：「無料（生成）」と「有料（評価）」
@@ -69,122 +1345,125 @@ with tab1:
         tags = selected_tags 
         wish = st.text_area("その他の願い・詳細（任意）", placeholder="例：春生まれなので、温かいイメージを入れたい")
 
-    uploaded_file = st.file_uploader("📸 写真やイラストからイメージする（任意）", type=['png', 'jpg', 'jpeg'])
+    uploaded_file = st.file_uploader("📸 写真やイラストからイメージする（任意）", type=['png', 'jpg', 'jpeg', 'webp'])
+    candidate_count = st.select_slider(
+        "提案してもらう候補の数", options=[3, 6, 9, 12, 15], value=3,
+        help="4つ以上のときは複数のリクエストを同時に送り、重複を除いて総合点の高い順に表示します。重複などで足りなくなった分は、1回だけ追加で提案してもらいます。"
+    )
+    force_fresh = st.checkbox("🔄 前回の結果を使わず、新しく考えてもらう", help="同じ条件で生成済みの場合は保存済みの結果を表示します。チェックすると必ずAIに新しく考えてもらいます。")
     submit_btn = st.button("✨ AIに名前を考えてもらう", use_container_width=True, type="primary")
 
     if submit_btn:
         if not wish and not uploaded_file:
             st.warning("「願い」を入力するか、「画像」をアップロードしてください！")
         else:
-            image_data_url = None
-            if uploaded_file:
-                encoded_image = base64.b64encode(uploaded_file.read()).decode('utf-8')
-                image_data_url = f"data:image/jpeg;base64,{encoded_image}"
-                st.info("📸 画像のイメージも考慮して名前を考えます！")
-
-            surname_instruction = f"苗字は「{surname}」です。" if surname else "苗字はありません。"
-
-            prompt = f"""
-            あなたはプロの命名アドバイザーです。
-            以下の条件に基づいて、最適な名前を3つ提案してください。
-
-            【入力情報】
-            ・苗字：{surname_instruction}
-            ・対象：{target_type}
-            ・性別：{gender}
-            ・使いたい漢字：{use_kanji}
-            ・避けたい漢字：{avoid_kanji}
-            【重要：イメージ・雰囲気】
-            ・選択された雰囲気タグ：{", ".join(tags) if tags else "指定なし"}
-            ・具体的な願い：{wish}
-            ※「雰囲気タグ」と「具体的な願い」の両方を考慮して、イメージに合う名前を考案してください。
-            ※画像が提供されている場合は、その視覚的イメージも反映してください。
-
-【最重要：名前の言語・文字種のルール】
-以下の優先順位（1が最強）で名前の雰囲気と文字種を決定してください。
-
-1. **「洋風」「洋風の響き」タグ、または「外国風」の指定がある場合（最優先）：**
-   ・苗字の有無に関わらず、**西洋的な響きを持つ名前**（例：アリス、レオ、エマ、アーサーなど）を提案してください。
-   ・表記は**「カタカナ」を基本**としますが、ユーザーが「使いたい漢字」を指定している場合のみ「当て字」を使ってください。
-
-2. 特定の国籍指定（「中国風」「韓国風」など）がある場合：
-   ・その文化圏に合った名前と表記（中国・韓国なら漢字、その他はカタカナ）で提案してください。
-
-3. 上記の指定がない場合（デフォルト）：
-   ・苗字が「漢字」または「苗字なし」の場合：**日本人の名前（漢字・ひらがな）**を提案。
-   ・苗字が「カタカナ」の場合：カタカナの名前を提案。
-   ・対象が「ファンタジー」「キャラクター」の場合：世界観に合わせて自由選択。
-
-            【重要：評価システム】
-            以下の5項目（各100点満点）と、「総合得点（100点満点）」を厳密に採点してください。
-            （響き、字形、独創、可読、願い）
-            ※「総合得点」は名前としての全体のバランス・完成度を加味してください。全体的に厳しめに採点してください。
-
-            【出力形式（JSON）】
-            必ず以下のJSONフォーマットのみを出力してください。
-            {{
-                "names": [
-                    {{
-                        "name": "名前の表記",
-                        "yomi": "読み仮名",
-                        "scores": {{
-                            "total": 0〜100,
-                            "hibiki": 0〜100,
-                            "jikei": 0〜100,
-                            "doku": 0〜100,
-                            "kadoku": 0〜100,
-                            "negai": 0〜100
-                        }},
-                        "reason": "名前の語源・本来の意味を明記し、願いをどう叶えるか解説してください。"
-                    }}
-                ]
-            }}
-            """
-
-            with st.spinner("💎 分析中..."):
-                try:
-                    messages = []
-                    if image_data_url:
-                        messages = [{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_data_url}}]}]
-                    else:
-                        messages = [{"role": "user", "content": prompt}]
-
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini", messages=messages, response_format={"type": "json_object"}
-                    )
-                    
-                    result_json = json.loads(response.choices[0].message.content)
-                    
-                    st.success("生成が完了しました！")
-
-                    for item in result_json["names"]:
-                        name, yomi, reason, scores = item["name"], item["yomi"], item["reason"], item["scores"]
-                        s_total = scores.get("total", 80)
-                        
-                        categories = ['響き', '字形', '独創', '可読', '願い']
-                        values = [scores.get("hibiki", 50), scores.get("jikei", 50), scores.get("doku", 50), scores.get("kadoku", 50), scores.get("negai", 50)]
-                        values += [values[0]]; categories += [categories[0]]; values += [values[0]]; categories += [categories[0]]
+            with trace_request("generation"):
+                image_data_url = None
+                image_digest = None
+                if uploaded_file:
+                    image_bytes = uploaded_file.getvalue()
+                    image_digest = hashlib.sha256(image_bytes).hexdigest()
+                    try:
+                        with measure("image_encode"):
+                            image_data_url = preprocess_image(image_digest, image_bytes)
+                        st.info("📸 画像のイメージも考慮して名前を考えます！")
+                    except (OSError, Image.DecompressionBombError) as e:
+                        record_error("image_encode", e)
+                        image_digest = None
+                        st.warning("画像を読み込めなかったため、画像なしで名前を考えます。")
 
-                        fig = go.Figure(data=[go.Scatterpolar(r=values, theta=categories, fill='toself', name=name, line_color='#00CC96')])
-                        fig.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 100])), showlegend=False, height=250, margin=dict(t=20, b=20, l=30, r=30))
+                cache_key = make_generation_cache_key(target_type, surname, gender, use_kanji, avoid_kanji, tags, wish, image_digest)
 
-                        with st.container(border=True):
-                            col_text, col_graph = st.columns([1.2, 1])
-                            with col_text:
-                                st.metric(label="🏅 総合評価", value=f"{s_total}点")
-                                st.caption("名前（コピーできます👇）")
-                                st.code(f"{name} ({yomi})", language=None)
-                                st.write(f"**理由:** {reason}")
-                            with col_graph:
-                                st.plotly_chart(fig, use_container_width=True)
+                with measure("prompt_build"):
+                    messages = build_generation_messages(target_type, surname, gender, use_kanji, avoid_kanji, tags, wish, image_data_url)
 
-                        st.session_state.generated_names.append({
-                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "対象": target_type, "名前": f"{name} ({yomi})", "総合点": s_total, "理由": reason
-                        })
+                with st.spinner("💎 分析中..."):
+                    try:
+                        status_area = st.empty()
+                        chart_area = st.empty()  # 「まとめて比較」のグラフは、全候補がそろってからカードの上に表示する
+                        use_list, avoid_list = normalize_kanji_list(use_kanji), normalize_kanji_list(avoid_kanji)
+                        received_count = rendered_count = 0  # ストリーミング中に受信済み・表示済みの名前の数
+                        content = None if force_fresh or candidate_count > GENERATION_BATCH_SIZE else cache_get(cache_key)
+                        from_cache = content is not None
+                        if candidate_count > GENERATION_BATCH_SIZE:
+                            request_count = candidate_count // GENERATION_BATCH_SIZE
+                            cache_keys = [
+                                make_generation_cache_key(target_type, surname, gender, use_kanji, avoid_kanji, tags, wish, image_digest, variant)
+                                for variant in range(request_count + 1)  # 最後の1つは、足りない候補を補う追加の指示の分
+                            ]
+                            top_up_key = cache_keys.pop()
+                            results, failed_count = generate_names_parallel(messages, cache_keys, force_fresh, use_list, avoid_list)
+                            names = [item for batch, _, _, _ in results for item in batch]
+                            salvaged_count = sum(salvaged for _, salvaged, _, _ in results)
+                            violation_count = sum(violations for _, _, violations, _ in results)
+                            replaced_count = sum(replaced for _, _, _, replaced in results)
+                            candidates, duplicates, rejected = merge_name_candidates(names, tags)
+                            merged_count = len(candidates) + duplicates + rejected
+                            candidates, topped_up = top_up_candidates(
+                                candidates, names, messages, top_up_key, force_fresh, tags, use_list, avoid_list, candidate_count
+                            )
+                            st.caption(
+                                f"🔀 {merged_count}件の候補から、重複 {duplicates}件・条件に合わない {rejected}件を除き、"
+                                + (f"追加で {topped_up}件を補って、" if topped_up else "")
+                                + f"総合点の高い順に {len(candidates)}件を表示しています"
+                            )
+                            if failed_count:
+                                st.warning(f"{request_count}回のうち{failed_count}回の生成に失敗しました。")
+                            names = candidates
+                        elif content is None and stream_mode:
+                            content = ""
+                            for piece in stream_completion(template="generation", model="gpt-4o-mini", messages=messages, response_format=GENERATION_RESPONSE_FORMAT):
+                                content += piece
+                                if "}" not in piece:
+                                    continue  # 名前1件分が閉じるまでは解析しない
+                                with measure("json_parse"):
+                                    partial, _ = parse_partial_json(content)
+                                for item in partial.get("names", [])[received_count:]:
+                                    received_count += 1
+                                    # 形式が壊れている候補や漢字の条件に合わない候補は表示せず、受信後に補充・差し替えする
+                                    if matches_schema(item, NAME_ITEM_SCHEMA) and not check_kanji_constraints(item["name"], item["yomi"], use_list, avoid_list):
+                                        render_name_card(item, target_type, tags, rendered_count)
+                                        rendered_count += 1
+                        elif content is None:
+                            response = create_with_retry(
+                                template="generation", model="gpt-4o-mini", messages=messages, response_format=GENERATION_RESPONSE_FORMAT
+                            )
+                            content = response.choices[0].message.content
+                        else:
+                            st.caption("⚡ 同じ条件で生成済みの結果を表示しています")
+
+                        if candidate_count <= GENERATION_BATCH_SIZE:
+                            names, salvaged_count, violation_count, replaced_count = finish_generation(
+                                content, messages, cache_key, from_cache, use_list, avoid_list
+                            )
+
+                        for index, item in enumerate(names[rendered_count:], start=rendered_count):
+                            render_name_card(item, target_type, tags, index)
+
+                        if chart_mode == "compare" and names:
+                            with chart_area.container():
+                                render_comparison_chart(names)
+
+                        if salvaged_count:
+                            st.caption(f"🩹 返答の一部が壊れていたため、{salvaged_count}件を追加で提案してもらいました")
+                        if replaced_count:
+                            st.caption(f"🔁 漢字の条件に合わなかった {violation_count}件のうち、{replaced_count}件を新しい候補に差し替えました")
+                        if violation_count > replaced_count:
+                            st.caption(
+                                f"✂️ 漢字の条件に合わなかった {violation_count - replaced_count}件は、条件どおりの代わりの候補が見つからなかったため除きました"
+                            )
+
+                        if names:
+                            status_area.success("生成が完了しました！")
+                        else:
+                            status_area.error("名前の候補を受け取れませんでした。少し時間をおいてから、もう一度お試しください。")
 
-                except Exception as e:
-                    st.error(f"エラーが発生しました: {e}")
+                    except (RateLimitError, ServerBusyError) as e:
+                        record_error("generation", e)
+                        st.warning("⏳ ただいま混み合っています。少し時間をおいてから、もう一度お試しください。")
+                    except Exception as e:
+                        record_error("generation", e)
+                        st.error(f"エラーが発生しました: {e}")
 
 
 # --------------------------------------------------
@@ -223,106 +1502,131 @@ with tab2:
             eval_name = st.text_input("名前（必須）", key="eval_name")
         with col_e3:
             eval_yomi = st.text_input("読み仮名（必須）", key="eval_yomi")
+
+        # 名前と読みが入力されたら、APIを使わずに計算できる指標をすぐに表示する
+        if eval_name and eval_yomi:
+            with st.container(border=True):
+                st.markdown("##### ⚡ クイックチェック（AIを使わない即時判定）")
+                render_local_scores(local_scores(eval_name, eval_yomi), person=eval_target.startswith("人間"))
+
+        escalation_threshold = st.slider(
+            "詳細レポートに進む基準（簡易診断の点数）", min_value=0, max_value=100, value=ESCALATION_THRESHOLD,
+            help="まず軽いモデルで仮の点数を出し、この点数以上の名前だけ詳細レポートを作成します。0にすると常に詳細レポートを作成します。一括診断にも使われます。"
+        )
         
         if st.button("詳細評価レポートを作成する", type="primary"):
             if not eval_name or not eval_yomi:
                 st.warning("「名前」と「読み仮名」は必ず入力してください。")
             else:
-                eval_prompt = f"""
-                あなたは世界トップクラスのネーミングコンサルタント・言語学者です。
-                ユーザーが考案した以下の名前を、プロの視点で多角的かつ厳密に診断してください。
-
-                【診断対象】
-                ・対象：{eval_target}
-                ・苗字：{eval_surname}
-                ・名前：{eval_name}
-                ・読み：{eval_yomi}
-                ・コンセプト/願い：{eval_wish}
-
-                以下の要素を分析し、必ず以下のJSONフォーマットで出力してください。
-                {{
-                  "overall": {{
-                    "score": 0〜100の総合点,
-                    "rank": "S, A, B, C のいずれか",
-                    "comment": "全体的な講評（2〜3文でプロ目線の鋭い評価）"
-                  }},
-                  "analysis": {{
-                    "phonetic": "音韻心理学的な分析（母音や子音の響きが与える印象）",
-                    "visual": "視覚的バランス・字形の印象（漢字や文字の並びの美しさ）"
-                  }},
-                  "global_risk": {{
-                    "risk_level": "低, 中, 高 のいずれか",
-                    "detail": "英語、中国語、その他の言語圏でネガティブな意味（スラング等）を持たないか、または特定の文化圏での文脈・ルーツに関する解説"
-                  }},
-                  "personas": [
-                    {{"target": "若年層(10-20代)", "impression": "どのような印象を抱くか"}},
-                    {{"target": "ビジネス層(30-50代)", "impression": "どのような印象を抱くか"}}
-                  ],
-                  "advice": "さらに名前を良くするための具体的な改善アドバイス",
-                  "alternatives": [
-                    {{"name": "提案1", "yomi": "ヨミ1", "reason": "改善理由"}},
-                    {{"name": "提案2", "yomi": "ヨミ2", "reason": "改善理由"}}
-                  ]
-                }}
-                """
-
-                with st.spinner("🔍 専門的な視点で多角的に分析中..."):
+
+                with st.spinner("🔍 専門的な視点で多角的に分析中..."), trace_request("evaluation"):
                     try:
-                        eval_response = client.chat.completions.create(
-                            model="gpt-4o", # プレミアム機能なので精度の高いモデル(GPT-4o)を推奨
-                            messages=[{"role": "user", "content": eval_prompt}],
-                            response_format={"type": "json_object"}
-                        )
-                        
-                        report = json.loads(eval_response.choices[0].message.content)
-                        
+                        eval_inputs = (eval_target, eval_surname, eval_name, eval_yomi, eval_wish)
+                        route, report, triage = plan_evaluation(*eval_inputs, escalation_threshold)
+
                         # --- レポートのUI描画 ---
                         st.markdown("---")
                         st.markdown(f"## 📋 【{eval_surname} {eval_name}】 診断レポート")
-                        
-                        # 1. 総合評価
-                        rank = report["overall"]["rank"]
-                        score = report["overall"]["score"]
-                        
-                        col_r1, col_r2 = st.columns([1, 2])
-                        with col_r1:
-                            st.metric(label="🏆 総合スコア", value=f"{score} / 100", delta=f"ランク {rank}", delta_color="normal" if rank in ["S", "A"] else "inverse")
-                        with col_r2:
-                            st.info(f"**コンサルタント講評:**\n\n{report['overall']['comment']}")
-
-                        # 2. 分析結果
-                        st.markdown("### 🔍 1. 音韻と視覚の分析")
-                        st.write(f"**🗣️ 音韻心理（響きの印象）:** {report['analysis']['phonetic']}")
-                        st.write(f"**👁️ 視覚バランス（字形）:** {report['analysis']['visual']}")
-                        
-                        # 3. リスク・文脈判定
-                        st.markdown("### 🌍 2. グローバルリスク・文脈の裏付け")
-                        risk = report["global_risk"]["risk_level"]
-                        if risk == "低":
-                            st.success(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
-                        elif risk == "中":
-                            st.warning(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
-                        else:
-                            st.error(f"**【リスク：{risk}】** {report['global_risk']['detail']}")
-
-                        # 4. ペルソナシミュレーション
-                        st.markdown("### 👥 3. ターゲット層別 受容度シミュレーション")
-                        for p in report["personas"]:
-                            st.markdown(f"- **{p['target']}:** {p['impression']}")
-
-                        # 5. プロのアドバイスと代替案
-                        st.markdown("### 💡 4. プロフェッショナル・アドバイス")
-                        st.write(report["advice"])
-                        
-                        with st.expander("✨ コンサルタントからの代替案（微調整バージョン）を見る"):
-                            for alt in report["alternatives"]:
-                                st.code(f"{alt['name']} ({alt['yomi']})", language=None)
-                                st.write(f"**理由:** {alt['reason']}")
-                                st.markdown("---")
-
+                        if triage is not None:
+                            render_triage(triage, route == "full", escalation_threshold)
+                        if route == "cache":
+                            st.caption("♻️ 以前に同じ条件で作成した診断レポートを表示しています。")
+                            for section in REPORT_SECTIONS:
+                                with measure("render"):
+                                    render_report_section(section, report)
+                        elif route == "full":
+                            with measure("prompt_build"):
+                                eval_messages = build_eval_messages(*eval_inputs)
+                            eval_request = dict(
+                                template="evaluation",
+                                model="gpt-4o", # プレミアム機能なので精度の高いモデル(GPT-4o)を推奨
+                                messages=eval_messages,
+                                response_format=EVAL_RESPONSE_FORMAT
+                            )
+
+                            # 項目ごとの表示場所を先に用意しておき、届いた順に埋めていく
+                            section_areas = {section: st.empty() for section in REPORT_SECTIONS}
+                            rendered_sections = set()
+
+                            if stream_mode:
+                                eval_content = ""
+                                for piece in stream_completion(**eval_request):
+                                    eval_content += piece
+                                    if "}" not in piece and "]" not in piece and '"' not in piece:
+                                        continue
+                                    with measure("json_parse"):
+                                        partial, pending = parse_partial_json(eval_content)
+                                    for section in REPORT_SECTIONS:
+                                        ready = section in partial and section != pending and section not in rendered_sections
+                                        if ready and matches_schema(partial[section], REPORT_SECTION_SCHEMAS[section]):
+                                            with measure("render"), section_areas[section].container():
+                                                render_report_section(section, partial)
+                                            rendered_sections.add(section)
+                            else:
+                                eval_response = create_with_retry(**eval_request)
+                                eval_content = eval_response.choices[0].message.content
+
+                            # 欠けた・壊れた項目があれば、その項目だけを追加で頼む
+                            report, missing_sections = complete_report(eval_messages, eval_content)
+                            for section in REPORT_SECTIONS:
+                                if section in report and section not in rendered_sections:
+                                    with measure("render"), section_areas[section].container():
+                                        render_report_section(section, report)
+                            if missing_sections:
+                                st.warning("一部の項目を取得できませんでした。もう一度お試しください。")
+                            else:
+                                save_report(*eval_inputs, report)
+
+                    except (RateLimitError, ServerBusyError) as e:
+                        record_error("evaluation", e)
+                        st.warning("⏳ ただいま混み合っています。少し時間をおいてから、もう一度お試しください。")
                     except Exception as e:
+                        record_error("evaluation", e)
                         st.error(f"評価中にエラーが発生しました: {e}")
                         
+        # --- 一括診断（候補リストをまとめて評価） ---
+        st.markdown("---")
+        st.markdown("#### 📂 候補リストをまとめて診断する")
+        with st.expander("CSV / JSONL ファイルから一括診断", expanded=False):
+            st.caption(f"列：surname（苗字）, name（名前）, yomi（読み）, target（対象）, wish（願い）。name と yomi は必須です。最大{BATCH_MAX_ROWS}件まで。target が空の行は上で選んだ「命名の対象」で診断します。")
+            batch_file = st.file_uploader("候補リストをアップロード", type=["csv", "jsonl"], key="batch_file")
+            # 1人が同時に送れる数（USER_MAX_CONCURRENT_REQUESTS）より多くしても、残りは順番待ちになるだけなので上限を合わせる
+            batch_workers = 1
+            if USER_MAX_CONCURRENT_REQUESTS > 1:
+                batch_workers = st.slider(
+                    "同時に診断する数", min_value=1, max_value=USER_MAX_CONCURRENT_REQUESTS, value=min(4, USER_MAX_CONCURRENT_REQUESTS),
+                    help=f"多くすると早く終わりますが、混雑時は自動で待ち時間を入れて再試行します。1人あたり同時に{USER_MAX_CONCURRENT_REQUESTS}件までです。"
+                )
+
+            if st.button("一括診断を開始する", disabled=batch_file is None):
+                try:
+                    batch_rows, overflow_count = load_batch_rows(batch_file, eval_target)
+                except ValueError as e:
+                    record_error("batch_load", e)
+                    st.error(f"ファイルを読み込めませんでした。CSV / JSONL の形式を確認してください。（{e}）")
+                else:
+                    if overflow_count:
+                        st.warning(f"上限の{BATCH_MAX_ROWS}件を超えた {overflow_count}件は診断しません。ファイルを分けてアップロードしてください。")
+                    if not batch_rows:
+                        st.warning("診断できる行がありません。「name」と「yomi」の列を確認してください。")
+                    else:
+                        progress_bar = st.progress(0.0, text=f"0 / {len(batch_rows)} 件")
+                        with trace_request("batch_evaluation"):
+                            st.session_state.batch_report = run_batch_evaluation(
+                                batch_rows, batch_workers,
+                                lambda done, total: progress_bar.progress(done / total, text=f"{done} / {total} 件"),
+                                escalation_threshold,
+                            )
+
+            if "batch_report" in st.session_state:
+                df_batch = st.session_state.batch_report
+                st.dataframe(df_batch, hide_index=True, use_container_width=True)
+                failed = (df_batch["エラー"] != "").sum()
+                if failed:
+                    st.warning(f"{failed} 件の診断に失敗しました（「エラー」列を確認してください）。")
+                batch_csv = df_batch.to_csv(index=False).encode('utf-8-sig')
+                st.download_button("📥 診断結果をCSVで保存", data=batch_csv, file_name=f"naming_report_{datetime.now().strftime('%Y%m%d')}.csv", mime='text/csv')
+
     elif user_password != "":
         st.error("コードが間違っています。")
 
@@ -330,11 +1634,64 @@ with tab2:
 # タブの外（アプリ全体に共通して表示される部分）
 # =====================================================================
 
-if st.session_state.generated_names:
-    df_log = pd.DataFrame(st.session_state.generated_names)
-    csv = df_log.to_csv(index=False).encode('utf-8-sig')
+history_count = count_history(history_owner)
+if history_count:
     st.sidebar.markdown("### 履歴管理")
-    st.sidebar.download_button("📥 履歴をCSVで保存", data=csv, file_name=f"naming_log_{datetime.now().strftime('%Y%m%d')}.csv", mime='text/csv')
+    st.sidebar.caption(f"保存されている名前：{history_count}件")
+    # ファイルの中身はボタンが押されたときに作る（毎回の再実行で履歴全体を書き出さない）
+    st.sidebar.download_button("📥 履歴をCSVで保存", data=lambda: export_history_csv(history_owner), file_name=f"naming_log_{datetime.now().strftime('%Y%m%d')}.csv", mime='text/csv')
+    st.sidebar.download_button("📦 履歴をParquetで保存", data=lambda: export_history_parquet(history_owner), file_name=f"naming_log_{datetime.now().strftime('%Y%m%d')}.parquet", mime='application/octet-stream')
+
+    with st.expander(f"🗂️ これまでに考えた名前（{history_count}件）"):
+        col_h1, col_h2, col_h3 = st.columns([2, 1, 1])
+        with col_h1:
+            history_keyword = st.text_input("名前・理由で検索", key="history_keyword", placeholder="例：陽")
+        with col_h2:
+            history_target = st.selectbox("対象", ["すべて", "人間", "ペット", "キャラクター"], key="history_target")
+        with col_h3:
+            history_order = st.selectbox("並び順", list(HISTORY_ORDERS), key="history_order")
+        history_target = None if history_target == "すべて" else history_target
+
+        matched_count = count_history(history_owner, history_keyword, history_target)
+        page_count = max(1, -(-matched_count // HISTORY_PAGE_SIZE))
+        history_page = st.number_input(f"ページ（全{page_count}ページ）", min_value=1, max_value=page_count, value=1, key="history_page")
+        df_history = query_history(
+            history_owner, history_keyword, history_target, history_order,
+            limit=HISTORY_PAGE_SIZE, offset=(history_page - 1) * HISTORY_PAGE_SIZE
+        )
+        st.dataframe(df_history, hide_index=True, use_container_width=True)
+        st.caption(f"{matched_count}件中 {len(df_history)}件を表示")
+
+with st.sidebar.expander("🔑 履歴の引き継ぎ"):
+    st.caption("再読み込みや別の端末で今の履歴を見るには、このコードを入力してください。コードを知っている人は誰でも履歴を見られるので、他の人には教えないでください。")
+    st.code(history_owner, language=None)
+    st.text_input("引き継ぎコード", key="history_restore_code", type="password")
+    st.button("履歴を読み込む", on_click=restore_history_owner)
+    if st.session_state.pop("history_restore_failed", False):
+        st.error("引き継ぎコードの形式が正しくありません。")
+
+counters = read_counters()
+if counters:
+    st.sidebar.markdown("### 利用状況")
+cache_hits, cache_misses = counters.get("hit", 0), counters.get("miss", 0)
+if cache_hits + cache_misses:
+    st.sidebar.caption(f"キャッシュ：ヒット {cache_hits} 回 / ミス {cache_misses} 回（ヒット率 {cache_hits / (cache_hits + cache_misses):.0%}）")
+for template, label in PROMPT_TEMPLATES.items():
+    calls = counters.get(f"calls:{template}", 0)
+    if calls:
+        st.sidebar.caption(
+            f"{label}：1回あたり 入力 {counters.get(f'prompt_tokens:{template}', 0) / calls:.0f}"
+            f"（うちキャッシュ {counters.get(f'cached_tokens:{template}', 0) / calls:.0f}）・"
+            f"出力 {counters.get(f'completion_tokens:{template}', 0) / calls:.0f} トークン（{calls}回）"
+        )
+route_counts = {route: counters.get(f"route:{route}", 0) for route in EVALUATION_ROUTES}
+if sum(route_counts.values()):
+    st.sidebar.caption("プレミアム診断の振り分け：" + "・".join(f"{EVALUATION_ROUTES[route]} {count}回" for route, count in route_counts.items()))
+if counters.get("kanji_checked"):
+    st.sidebar.caption(
+        f"漢字の条件の違反率 {counters.get('kanji_violations', 0) / counters['kanji_checked']:.0%}"
+        f"（{counters['kanji_checked']}件中 {counters.get('kanji_violations', 0)}件）"
+    )
 
 st.markdown("---")
 col_feedback1, col_feedback2 = st.columns([2, 1])
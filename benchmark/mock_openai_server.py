@@ -0,0 +1,218 @@
+# OpenAI互換のローカルサーバー（ベンチマーク・負荷試験用のスタンドイン）
+# /v1/chat/completions だけを実装し、response_format の JSON スキーマ名に合わせたダミーの返答を返す。
+# 応答までの待ち時間・ストリーミングの速さ・429/5xx エラーや途中で切れた返答の発生率を設定できる。
+#
+# 単体で起動する場合：
+#   python benchmark/mock_openai_server.py --port 8900 --latency 0.8 --rate-429 0.05
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=dummy streamlit run "app ver.2 .py"
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# スキーマ名ごとのダミーの返答
+NAME_PROPOSALS = {
+    "names": [
+        {"name": "陽菜", "yomi": "ひな", "scores": {"total": 86, "hibiki": 88, "jikei": 80, "doku": 62, "kadoku": 92, "negai": 85}, "reason": "「陽」は太陽の光、「菜」は若葉を表し、春の温かさと健やかな成長への願いを込めています。"},
+        {"name": "結衣", "yomi": "ゆい", "scores": {"total": 81, "hibiki": 84, "jikei": 78, "doku": 58, "kadoku": 90, "negai": 80}, "reason": "「結」は人と人を結ぶ縁、「衣」は人を包むやさしさを表します。"},
+        {"name": "咲良", "yomi": "さくら", "scores": {"total": 78, "hibiki": 86, "jikei": 74, "doku": 66, "kadoku": 72, "negai": 82}, "reason": "花が咲くように明るく、良い人生を歩んでほしいという願いを込めています。"},
+    ]
+}
+NAME_REPORT = {
+    "overall": {"score": 82, "rank": "A", "comment": "響きと字形のバランスが良く、幅広い層に受け入れられる名前です。"},
+    "analysis": {"phonetic": "母音 i-a の並びが明るく開放的な印象を与えます。", "visual": "画数の差が小さく、縦書きでも横書きでも安定して見えます。"},
+    "global_risk": {"risk_level": "低", "detail": "主要な言語圏で否定的な意味を持つ語は見当たりません。"},
+    "personas": [
+        {"target": "若年層(10-20代)", "impression": "親しみやすく、今どきの印象。"},
+        {"target": "ビジネス層(30-50代)", "impression": "落ち着いていて信頼感がある。"},
+    ],
+    "advice": "読みを一文字変えると、より独自性が高まります。",
+    "alternatives": [
+        {"name": "陽奈", "yomi": "ひな", "reason": "「奈」にすると字形が引き締まります。"},
+        {"name": "日菜", "yomi": "ひな", "reason": "画数が少なく書きやすくなります。"},
+    ],
+}
+NAME_TRIAGE = {"score": 74, "comment": "響きが明るく読みやすい一方、独自性はやや控えめです。"}
+RESPONSES = {"name_proposals": NAME_PROPOSALS, "name_report": NAME_REPORT, "name_triage": NAME_TRIAGE}
+
+
+class MockSettings:
+    def __init__(self, latency=0.5, jitter=0.2, chunk_size=8, chunk_interval=0.01, rate_429=0.0, rate_5xx=0.0, rate_truncated=0.0, seed=None):
+        self.latency = latency                # 最初の返答（ストリーミングなら最初のチャンク）までの秒数
+        self.jitter = jitter                  # latency に加えるばらつき（0〜この秒数）
+        self.chunk_size = chunk_size          # ストリーミング1チャンクあたりの文字数
+        self.chunk_interval = chunk_interval  # チャンクを送る間隔（秒）
+        self.rate_429 = rate_429              # 429（混雑）を返す割合
+        self.rate_5xx = rate_5xx              # 500/503 を返す割合
+        self.rate_truncated = rate_truncated  # 返答のJSONを途中で切って返す割合
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.truncated = 0
+
+    def roll(self):
+        with self.lock:
+            self.requests += 1
+            value = self.random.random()
+            if value < self.rate_429:
+                self.errors += 1
+                return 429
+            if value < self.rate_429 + self.rate_5xx:
+                self.errors += 1
+                return self.random.choice([500, 503])
+            return 200
+
+    def truncate(self, content):
+        # 一定の割合で、返答を途中（4〜9割の位置）で切る
+        with self.lock:
+            if self.random.random() >= self.rate_truncated:
+                return content
+            self.truncated += 1
+            return content[:int(len(content) * self.random.uniform(0.4, 0.9))]
+
+    def wait(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        time.sleep(delay)
+
+
+def response_content(request):
+    # response_format のスキーマ名から返す内容を決める（不明なときは、スキーマの項目に合わせて診断レポートから抜き出す）
+    json_schema = (request.get("response_format") or {}).get("json_schema", {})
+    schema_name = json_schema.get("name", "name_proposals")
+    if schema_name in RESPONSES:
+        return json.dumps(RESPONSES[schema_name], ensure_ascii=False)
+    properties = json_schema.get("schema", {}).get("properties", {})
+    return json.dumps({key: NAME_REPORT[key] for key in properties if key in NAME_REPORT} or NAME_PROPOSALS, ensure_ascii=False)
+
+
+def usage_for(request, content):
+    # トークン数の目安（文字数から大まかに見積もる）
+    prompt_chars = len(json.dumps(request.get("messages", []), ensure_ascii=False))
+    prompt_tokens, completion_tokens = prompt_chars // 2, len(content) // 2
+    return {
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+
+def make_handler(settings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass  # アクセスログは出さない
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+                return
+
+            settings.wait()
+            status = settings.roll()
+            if status == 429:
+                self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}}, {"Retry-After": "0.2"})
+                return
+            if status != 200:
+                self.send_json(status, {"error": {"message": "Server error (mock)", "type": "server_error"}})
+                return
+
+            content = settings.truncate(response_content(request))
+            completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+            model = request.get("model", "mock")
+            if request.get("stream"):
+                self.stream(request, content, completion_id, model)
+            else:
+                self.send_json(200, {
+                    "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": usage_for(request, content),
+                })
+
+        def stream(self, request, content, completion_id, model):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            def send_event(payload):
+                self.wfile.write(f"data: {payload}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            def chunk(delta, finish_reason=None):
+                return {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+
+            send_event(json.dumps(chunk({"role": "assistant", "content": ""}), ensure_ascii=False))
+            for start in range(0, len(content), settings.chunk_size):
+                send_event(json.dumps(chunk({"content": content[start:start + settings.chunk_size]}), ensure_ascii=False))
+                time.sleep(settings.chunk_interval)
+            send_event(json.dumps(chunk({}, "stop"), ensure_ascii=False))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                final = chunk({})
+                final["choices"] = []
+                final["usage"] = usage_for(request, content)
+                send_event(json.dumps(final, ensure_ascii=False))
+            send_event("[DONE]")
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(settings, host="127.0.0.1", port=0):
+    # バックグラウンドのスレッドでサーバーを起動し、(サーバー, ベースURL) を返す
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.5, help="最初の返答までの秒数")
+    parser.add_argument("--jitter", type=float, default=0.2, help="待ち時間のばらつき（秒）")
+    parser.add_argument("--chunk-size", type=int, default=8, help="ストリーミング1チャンクの文字数")
+    parser.add_argument("--chunk-interval", type=float, default=0.01, help="チャンクの送信間隔（秒）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="429 を返す割合（0〜1）")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="500/503 を返す割合（0〜1）")
+    parser.add_argument("--rate-truncated", type=float, default=0.0, help="返答のJSONを途中で切って返す割合（0〜1）")
+    parser.add_argument("--seed", type=int, default=None, help="乱数のシード（結果を再現したいとき）")
+
+
+def settings_from_args(args):
+    return MockSettings(
+        latency=args.latency, jitter=args.jitter, chunk_size=args.chunk_size, chunk_interval=args.chunk_interval,
+        rate_429=args.rate_429, rate_5xx=args.rate_5xx, rate_truncated=args.rate_truncated, seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI互換のモックサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server, base_url = start_server(settings_from_args(args), args.host, args.port)
+    print(f"モックサーバーを起動しました：OPENAI_BASE_URL={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
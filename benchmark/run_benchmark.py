@@ -0,0 +1,307 @@
+# 名前生成・プレミアム診断の負荷試験（本物のAPIは使わない）
+# ローカルのモックサーバーに向けてアプリを `streamlit run` で起動し、ブラウザと同じ WebSocket の通信で
+# N 人分のセッションを同時に動かして、待ち時間（p50/p95/p99）・スループット・
+# スクリプト再実行のコスト・1セッションあたりのメモリを報告する。
+#
+# 使い方（リポジトリのルートで実行。アプリの依存関係に加えて websockets が必要）：
+#   pip install -r benchmark/requirements.txt
+#   python benchmark/run_benchmark.py --sessions 20 --concurrency 10
+#   python benchmark/run_benchmark.py --flow evaluate --latency 1.5 --rate-429 0.1 --json result.json
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+from mock_openai_server import add_settings_arguments, settings_from_args, start_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app ver.2 .py")
+SECRET_CODE = "copenhagen"
+FLOWS = ["generate", "evaluate"]
+FINISHED_SUCCESSFULLY = ForwardMsg.ScriptFinishedStatus.Value("FINISHED_SUCCESSFULLY")
+FINISHED_WITH_COMPILE_ERROR = ForwardMsg.ScriptFinishedStatus.Value("FINISHED_WITH_COMPILE_ERROR")
+
+
+def percentile(values, p):
+    # 最近接順位法による百分位数（値がなければ None）
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def resident_memory_kib(pid):
+    # プロセスの常駐メモリ（Linux の /proc から読む。読めない環境では None）
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def start_app(port, env):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP_PATH,
+         "--server.headless", "true", "--server.port", str(port), "--server.address", "127.0.0.1",
+         "--browser.gatherUsageStats", "false", "--server.fileWatcherType", "none"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return process
+        except OSError:
+            time.sleep(0.3)
+    process.kill()
+    raise RuntimeError("アプリが起動しませんでした")
+
+
+class Session:
+    """ブラウザの代わりに1人分の画面を操作する"""
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.ws = None
+        self.query_string = ""
+        self.page_script_hash = ""
+        self.widgets = {}   # ラベル -> ウィジェットID（直前の実行で表示されたもの）
+        self.states = {}    # ウィジェットID -> 送信する値
+        self.failures = []  # 直前の実行で表示されたエラー
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, subprotocols=["streamlit"], max_size=None)
+        return await self.rerun()
+
+    async def close(self):
+        await self.ws.close()
+
+    def find(self, label):
+        return next(widget_id for widget_label, widget_id in self.widgets.items() if widget_label.startswith(label))
+
+    def set_value(self, label, field, value):
+        state = WidgetState(id=self.find(label))
+        if field == "string_array_value":
+            state.string_array_value.data[:] = value
+        else:
+            setattr(state, field, value)
+        self.states[state.id] = state
+
+    async def rerun(self, trigger=None):
+        # 現在の入力値で再実行し、スクリプトが最後まで終わるまでの秒数を返す
+        message = BackMsg()
+        message.rerun_script.query_string = self.query_string
+        message.rerun_script.page_script_hash = self.page_script_hash
+        message.rerun_script.widget_states.widgets.extend(self.states.values())
+        if trigger:
+            message.rerun_script.widget_states.widgets.append(WidgetState(id=self.find(trigger), trigger_value=True))
+        self.widgets, self.failures = {}, []
+        started = time.perf_counter()
+        await self.ws.send(message.SerializeToString())
+        await asyncio.wait_for(self.receive_until_finished(), self.timeout)
+        return time.perf_counter() - started
+
+    async def receive_until_finished(self):
+        while True:
+            message = ForwardMsg()
+            message.ParseFromString(await self.ws.recv())
+            kind = message.WhichOneof("type")
+            if kind == "new_session":
+                self.page_script_hash = message.new_session.page_script_hash
+            elif kind == "page_info_changed":
+                self.query_string = message.page_info_changed.query_string
+            elif kind == "delta" and message.delta.WhichOneof("type") == "new_element":
+                self.read_element(message.delta.new_element)
+            elif kind == "script_finished" and message.script_finished in (FINISHED_SUCCESSFULLY, FINISHED_WITH_COMPILE_ERROR):
+                if message.script_finished == FINISHED_WITH_COMPILE_ERROR:
+                    self.failures.append("compile error")
+                return
+
+    def read_element(self, element):
+        element_type = element.WhichOneof("type")
+        proto = getattr(element, element_type)
+        if element_type == "alert" and proto.format == proto.ERROR:
+            self.failures.append(f"error: {proto.body}")
+        elif element_type == "exception":
+            self.failures.append(f"exception: {proto.type}: {proto.message}")
+        elif getattr(proto, "id", "") and hasattr(proto, "label"):
+            self.widgets[proto.label] = proto.id
+
+
+async def run_generate(session, index, args):
+    session.set_value("その他の願い・詳細", "string_value", f"ベンチマーク用の願い #{index}" if not args.repeat_conditions else "ベンチマーク用の願い")
+    session.set_value("提案してもらう候補の数", "string_array_value", [str(args.candidates)])
+    return await session.rerun(trigger="✨ AIに名前を考えてもらう")
+
+
+async def run_evaluate(session, index, args):
+    session.set_value("アクセスコードを入力", "string_value", SECRET_CODE)
+    await session.rerun()
+    session.set_value("名前（必須）", "string_value", "陽菜")
+    session.set_value("読み仮名（必須）", "string_value", "ひな")
+    session.set_value("この名前に込めた想い", "string_value", f"ベンチマーク用の想い #{index}" if not args.repeat_conditions else "")
+    return await session.rerun(trigger="詳細評価レポートを作成する")
+
+
+RUNNERS = {"generate": run_generate, "evaluate": run_evaluate}
+
+
+async def run_session(index, session, args):
+    # 1人分の操作：各フローを1回ずつ実行したあと、何も操作せずに再実行してコストを測る
+    result = {"latency": {}, "failures": [], "rerun": []}
+    session.set_value("⚡ 届いた結果から順に表示する", "bool_value", not args.no_stream)
+    for flow in args.flows:
+        try:
+            result["latency"][flow] = await RUNNERS[flow](session, index, args)
+        except Exception as e:
+            result["failures"].append(f"{flow}: {type(e).__name__}: {e}")
+            continue
+        result["failures"].extend(f"{flow}: {failure}" for failure in session.failures)
+    for _ in range(args.reruns):
+        result["rerun"].append(await session.rerun())
+    return result
+
+
+async def drive_sessions(url, args, process):
+    limit = asyncio.Semaphore(args.concurrency)
+    sessions, results = [], []
+
+    # 初回の読み込み（import や st.cache_resource の初期化）は計測から外す
+    warmup = Session(url, args.timeout)
+    await warmup.connect()
+    await warmup.close()
+    memory_before = resident_memory_kib(process.pid)
+
+    async def worker(index):
+        async with limit:
+            session = Session(url, args.timeout)
+            sessions.append(session)  # メモリを測るまで接続を保ったままにする
+            await session.connect()
+            results.append(await run_session(index, session, args))
+            if not args.quiet:
+                print(f"  セッション {len(results)}/{args.sessions} 完了", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+
+    memory_after = resident_memory_kib(process.pid)
+    for session in sessions:
+        await session.close()
+    memory = None
+    if memory_before is not None and memory_after is not None:
+        memory = {"before_kib": memory_before, "after_kib": memory_after, "per_session_kib": (memory_after - memory_before) / args.sessions}
+    return results, elapsed, memory
+
+
+def run_benchmark(args):
+    mock = settings_from_args(args)
+    server, base_url = start_server(mock)
+    workdir = tempfile.mkdtemp(prefix="namers-bench-")
+    # 本物のAPI・本番のDBに触れないよう、環境変数で向き先を変えてアプリを起動する
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=base_url,
+        OPENAI_API_KEY="mock-key",
+        NAMERS_CACHE_DB=os.path.join(workdir, "cache.sqlite3"),
+        NAMERS_HISTORY_DB=os.path.join(workdir, "history.sqlite3"),
+    )
+    port = free_port()
+    process = start_app(port, env)
+    try:
+        results, elapsed, memory = asyncio.run(drive_sessions(f"ws://127.0.0.1:{port}/_stcore/stream", args, process))
+    finally:
+        process.terminate()
+        process.wait()
+        server.shutdown()
+
+    return {
+        "settings": {
+            "sessions": args.sessions, "concurrency": args.concurrency, "flows": args.flows,
+            "stream": not args.no_stream, "candidates": args.candidates,
+            "latency": args.latency, "rate_429": args.rate_429, "rate_5xx": args.rate_5xx, "rate_truncated": args.rate_truncated,
+        },
+        "elapsed_seconds": elapsed,
+        "latency": {flow: summarize([r["latency"][flow] for r in results if flow in r["latency"]]) for flow in args.flows},
+        "throughput_per_second": {flow: sum(flow in r["latency"] for r in results) / elapsed for flow in args.flows},
+        "rerun": summarize([t for r in results for t in r["rerun"]]),
+        "memory": memory,
+        "failures": [f for r in results for f in r["failures"]],
+        "mock_server": {"requests": mock.requests, "injected_errors": mock.errors, "truncated_responses": mock.truncated},
+    }
+
+
+def print_report(report):
+    def fmt(value):
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    settings = report["settings"]
+    print(f"\n経過時間: {report['elapsed_seconds']:.1f} 秒（{settings['sessions']} セッション、同時 {settings['concurrency']}）")
+    print(f"{'':20}{'件数':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'最大':>10}")
+    rows = list(report["latency"].items()) + [("再実行（操作なし）", report["rerun"])]
+    for label, stats in rows:
+        print(f"{label:20}{stats['count']:>6}{fmt(stats['p50']):>10}{fmt(stats['p95']):>10}{fmt(stats['p99']):>10}{fmt(stats['max']):>10}")
+    for flow, value in report["throughput_per_second"].items():
+        print(f"スループット（{flow}）: {value:.2f} 件/秒")
+    memory = report["memory"]
+    if memory:
+        print(f"メモリ: 1セッションあたり {memory['per_session_kib']:.0f} KiB（{memory['before_kib'] / 1024:.0f} MiB → {memory['after_kib'] / 1024:.0f} MiB）")
+    mock = report["mock_server"]
+    print(f"モックサーバー: {mock['requests']} リクエスト（うち注入したエラー {mock['injected_errors']} 件・途中で切った返答 {mock['truncated_responses']} 件）")
+    if report["failures"]:
+        print(f"失敗: {len(report['failures'])} 件")
+        for failure in report["failures"][:10]:
+            print(f"  - {failure}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="名前生成・プレミアム診断の負荷試験（モックサーバー使用）")
+    parser.add_argument("--sessions", type=int, default=10, help="動かすセッション（利用者）の数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時に動かすセッションの数")
+    parser.add_argument("--flow", choices=FLOWS + ["both"], default="both", help="計測するフロー")
+    parser.add_argument("--candidates", type=int, default=3, choices=[3, 6, 9, 12, 15], help="名前生成の候補数")
+    parser.add_argument("--no-stream", action="store_true", help="ストリーミング表示をオフにする")
+    parser.add_argument("--repeat-conditions", action="store_true", help="全員が同じ条件で送る（キャッシュが効く場合を測る）")
+    parser.add_argument("--reruns", type=int, default=3, help="1セッションで操作なしの再実行を測る回数")
+    parser.add_argument("--timeout", type=float, default=120, help="1回の再実行を待つ上限（秒）")
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    parser.add_argument("--quiet", action="store_true", help="進み具合を表示しない")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    args.flows = FLOWS if args.flow == "both" else [args.flow]
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,264 @@
+# 処理の各段階（プロンプト作成・画像変換・API・JSON解析・グラフ作成・表示）の時間、
+# トークン数、キャッシュの効き具合、エラーの種類を計測するモジュール。
+# 集計値は Prometheus 形式で公開でき、ユーザーの操作1回ごとの内訳は1行のJSONログとして出力する。
+# Streamlit はスクリプトを毎回実行し直すが、このモジュールは1度しか読み込まれないので、集計値はプロセス全体で共有される。
+import contextvars  # 操作1回分の計測結果を、並列処理のスレッドにも引き継ぐ
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("namers.metrics")
+
+# 秒数のヒストグラムの区切り（画像の変換のような数ミリ秒の処理から、混雑時のAPIの待ち時間まで）
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    "namers_stage_seconds": ("histogram", "処理の段階ごとの所要時間"),
+    "namers_api_seconds": ("histogram", "APIの呼び出しにかかった時間（再試行の待ち時間を含む）"),
+    "namers_api_first_token_seconds": ("histogram", "ストリーミングで最初の文字が届くまでの時間"),
+    "namers_api_requests_total": ("counter", "APIの呼び出し回数"),
+    "namers_tokens_total": ("counter", "使用したトークン数"),
+    "namers_cache_requests_total": ("counter", "キャッシュの参照回数（kind=generation は生成結果、evaluation_report・evaluation_triage は診断結果）"),
+    "namers_errors_total": ("counter", "発生したエラーの数（種類別）"),
+    "namers_requests_total": ("counter", "ユーザーの操作（名前の生成・診断）の回数"),
+    "namers_evaluation_routes_total": ("counter", "プレミアム診断の振り分け先（保存済みの結果・簡易診断で終了・詳細診断）の回数"),
+    "namers_evaluation_cost_usd_total": ("counter", "プレミアム診断の費用の目安（baseline=常に詳細診断した場合, actual=振り分け後）"),
+}
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry:
+    """カウンターとヒストグラムをスレッドから安全に集計し、Prometheus のテキスト形式で書き出す"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (名前, ラベル) -> 値
+        self.histograms = {}  # (名前, ラベル) -> [区切りごとの件数, 合計, 件数]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(SECONDS_BUCKETS), 0.0, 0))
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, SECONDS_BUCKETS)]
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    def render(self):
+        with self.lock:
+            counters, histograms = dict(self.counters), dict(self.histograms)
+        lines, described = [], set()
+
+        def describe(name):
+            if name not in described and name in METRIC_HELP:
+                kind, text = METRIC_HELP[name]
+                lines.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+            described.add(name)
+
+        for (name, key), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{format_labels(key)} {value}")
+        for (name, key), (buckets, total, count) in sorted(histograms.items()):
+            describe(name)
+            for bound, n in zip(SECONDS_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{format_labels(key, [('le', bound)])} {n}")
+            lines.append(f"{name}_bucket{format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{format_labels(key)} {total}")
+            lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+# =====================================================================
+# 操作1回分の計測（名前の生成・診断ごとに、段階別の時間・API呼び出し・トークン数をまとめる）
+# =====================================================================
+class RequestTrace:
+    def __init__(self, flow):
+        self.id = uuid.uuid4().hex[:12]
+        self.flow = flow
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}     # 段階 -> 合計秒数（同じ段階を何度も通る場合は合計する）
+        self.api_calls = []
+        self.tokens = {}
+        self.cache = {}
+        self.errors = []
+        self.routes = {}     # プレミアム診断の振り分け先 -> 回数
+        self.cost_usd = {}   # "baseline"（常に詳細診断した場合）と "actual"（振り分け後）の費用の目安
+        self.error = None    # 操作全体が失敗したときのエラーの種類
+
+    def add(self, field, name, amount):
+        with self.lock:
+            values = getattr(self, field)
+            values[name] = values.get(name, 0) + amount
+
+    def add_api_call(self, **fields):
+        with self.lock:
+            self.api_calls.append(fields)
+
+    def to_log(self):
+        return {
+            "event": "request", "request_id": self.id, "flow": self.flow,
+            "seconds": round(time.perf_counter() - self.started, 4),
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "api_calls": self.api_calls, "tokens": self.tokens, "cache": self.cache,
+            "routes": self.routes, "cost_usd": {kind: round(usd, 6) for kind, usd in self.cost_usd.items()},
+            "errors": self.errors, "error": self.error,
+        }
+
+
+current_trace = contextvars.ContextVar("namers_trace", default=None)
+
+
+@contextmanager
+def trace_request(flow):
+    # この中で計測したものは、終わったときに1行のJSONログにまとめて出力する
+    trace = RequestTrace(flow)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = type(e).__name__
+        raise
+    finally:
+        current_trace.reset(token)
+        registry.inc("namers_requests_total", flow=flow, result="error" if trace.error else "ok")
+        registry.observe("namers_stage_seconds", time.perf_counter() - trace.started, stage=f"{flow}_total")
+        log_event(trace.to_log())
+
+
+@contextmanager
+def measure(stage):
+    # 処理1段階分の時間を計る
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        registry.observe("namers_stage_seconds", elapsed, stage=stage)
+        trace = current_trace.get()
+        if trace:
+            trace.add("stages", stage, elapsed)
+
+
+def record_api_call(template, model, seconds, first_token_seconds=None, error=None):
+    registry.inc("namers_api_requests_total", template=template, model=model, result=error or "ok")
+    registry.observe("namers_api_seconds", seconds, template=template, model=model)
+    if first_token_seconds is not None:
+        registry.observe("namers_api_first_token_seconds", first_token_seconds, template=template, model=model)
+    trace = current_trace.get()
+    if trace:
+        call = {"template": template, "model": model, "seconds": round(seconds, 4), "error": error}
+        if first_token_seconds is not None:
+            call["first_token_seconds"] = round(first_token_seconds, 4)
+        trace.add_api_call(**call)
+
+
+def record_tokens(template, **amounts):
+    trace = current_trace.get()
+    for kind, amount in amounts.items():
+        registry.inc("namers_tokens_total", amount, template=template, kind=kind)
+        if trace:
+            trace.add("tokens", kind, amount)
+
+
+def record_cache(result, kind="generation"):
+    # result は "hit" か "miss"、kind は何のキャッシュか（生成結果以外は、ログでは "evaluation_report_hit" のように区別する）
+    registry.inc("namers_cache_requests_total", kind=kind, result=result)
+    trace = current_trace.get()
+    if trace:
+        trace.add("cache", result if kind == "generation" else f"{kind}_{result}", 1)
+
+
+def record_error(where, error):
+    # 画面にエラーを表示して処理を続ける場合や、再試行で持ち直した場合も、種類ごとに数えて記録に残す。
+    # where が操作の名前（"generation" など）と同じときは、その操作全体の失敗として扱う
+    registry.inc("namers_errors_total", where=where, error=type(error).__name__)
+    trace = current_trace.get()
+    if trace:
+        with trace.lock:
+            trace.errors.append({"where": where, "error": type(error).__name__})
+        if where == trace.flow:
+            trace.error = type(error).__name__
+
+
+def record_route(route, baseline_usd, actual_usd, **details):
+    # プレミアム診断をどこまで進めたかと、その費用の目安を記録する（判断1回ごとに1行のJSONログも出す）
+    registry.inc("namers_evaluation_routes_total", route=route)
+    registry.inc("namers_evaluation_cost_usd_total", baseline_usd, kind="baseline")
+    registry.inc("namers_evaluation_cost_usd_total", actual_usd, kind="actual")
+    trace = current_trace.get()
+    if trace:
+        trace.add("routes", route, 1)
+        trace.add("cost_usd", "baseline", baseline_usd)
+        trace.add("cost_usd", "actual", actual_usd)
+    log_event({
+        "event": "evaluation_route", "request_id": trace.id if trace else None, "route": route,
+        "baseline_usd": round(baseline_usd, 6), "actual_usd": round(actual_usd, 6),
+        "saved_usd": round(baseline_usd - actual_usd, 6), **details,
+    })
+
+
+# =====================================================================
+# 出力先（構造化ログと、Prometheus 用の /metrics）
+# =====================================================================
+def log_event(event):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(event, ensure_ascii=False))
+
+
+def configure_json_log(path):
+    # path が "-" なら標準エラー出力、それ以外はそのファイルに1行1件のJSONを追記する
+    handler = logging.StreamHandler() if path == "-" else logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    # Streamlit とは別のポートで /metrics を公開する（バックグラウンドのスレッドで動かす）。
+    # 既定ではこのマシンの中からだけ接続できる
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,418 @@
+# 名前の機械的に計算できる指標（文字数・音の数・母音・画数・読みやすさ・他言語での悪い意味）を
+# APIを使わずにその場で計算するモジュール。AIの採点の前の「目安」や、候補のふるい分けに使う。
+import unicodedata  # 全角・半角などの表記ゆれを揃える
+
+# =====================================================================
+# 漢字の表（名付けによく使われる漢字を中心に収録）
+# 漢字: (画数, 区分, 読み)  区分は「常用」（常用漢字）・「人名」（人名用漢字）・「表外」（どちらでもなく、人の名前として届け出できない）
+# 読みは音読み・訓読み・名乗り（名前だけで使う読み）をひらがなで並べたもの
+# 収録していない漢字は「未収録」として扱い、点数の計算から除く
+# =====================================================================
+KANJI_TABLE = {
+    "愛": (13, "常用", "あい まな めぐ え"), "安": (6, "常用", "あん やす"), "依": (8, "常用", "い え より"),
+    "郁": (9, "人名", "いく かおる ふみ"), "一": (1, "常用", "いち いつ かず はじめ ひと"), "伊": (6, "常用", "い これ よし"),
+    "羽": (6, "常用", "う は わ ば"), "英": (8, "常用", "えい ひで はな"), "永": (5, "常用", "えい なが とわ ひさ"),
+    "栄": (9, "常用", "えい さかえ はる ひで よし"), "衣": (6, "常用", "い え ころも きぬ"), "瑛": (12, "人名", "えい あきら てる"),
+    "音": (9, "常用", "おん いん おと ね"), "佳": (8, "常用", "か けい よし"), "花": (7, "常用", "か け はな"),
+    "華": (10, "常用", "か け はな"), "夏": (10, "常用", "か げ なつ"), "歌": (14, "常用", "か うた"),
+    "海": (9, "常用", "かい うみ み"), "絵": (12, "常用", "かい え"), "快": (7, "常用", "かい よし"),
+    "楓": (13, "人名", "ふう かえで"), "葵": (12, "人名", "き あおい まもる"), "岳": (8, "常用", "がく たけ"),
+    "寛": (13, "常用", "かん ひろ ひろし とも"), "幹": (13, "常用", "かん みき もと"), "貫": (11, "常用", "かん つら ぬき"),
+    "環": (17, "常用", "かん たまき たま"), "希": (7, "常用", "き け のぞみ のぞ まれ"), "輝": (15, "常用", "き てる ひかる あき"),
+    "喜": (12, "常用", "き よし のぶ"), "紀": (9, "常用", "き のり とし"), "貴": (12, "常用", "き たか たかし あて"),
+    "菊": (11, "常用", "きく"), "吉": (6, "常用", "きち きつ よし"), "久": (3, "常用", "きゅう く ひさ"),
+    "京": (8, "常用", "きょう けい みやこ"), "恭": (10, "常用", "きょう やす たか"), "響": (20, "常用", "きょう ひびき ひびく"),
+    "杏": (7, "人名", "あん きょう あんず"), "叶": (5, "人名", "きょう かな かなう かなえ"), "琴": (12, "常用", "きん こと"),
+    "銀": (14, "常用", "ぎん"), "空": (8, "常用", "くう そら たか あ"), "薫": (16, "常用", "くん かおる かおり かお"),
+    "恵": (10, "常用", "けい え めぐみ めぐ"), "景": (12, "常用", "けい かげ"), "慧": (15, "人名", "けい え さと さとし"),
+    "健": (11, "常用", "けん たけ たけし やす"), "賢": (16, "常用", "けん まさ さと さとし かしこ"), "謙": (17, "常用", "けん ゆずる かね"),
+    "絢": (12, "人名", "けん じゅん あや"), "源": (13, "常用", "げん みなもと もと"), "弦": (8, "常用", "げん つる いと"),
+    "元": (4, "常用", "げん がん もと はじめ"), "光": (6, "常用", "こう ひかり ひかる みつ てる あき"), "幸": (8, "常用", "こう さち ゆき さき"),
+    "康": (11, "常用", "こう やす"), "航": (10, "常用", "こう わたる"), "浩": (10, "常用", "こう ひろ ひろし"),
+    "晃": (10, "人名", "こう あき あきら てる"), "功": (5, "常用", "こう く いさお のり"), "孝": (7, "常用", "こう たか のり"),
+    "広": (5, "常用", "こう ひろ ひろし"), "虹": (9, "常用", "こう にじ"), "高": (10, "常用", "こう たか"),
+    "心": (4, "常用", "しん こころ み ここ"), "紗": (10, "人名", "さ しゃ すず"), "彩": (11, "常用", "さい あや いろ"),
+    "咲": (9, "常用", "さ さき さく えみ"), "桜": (10, "常用", "おう さくら"), "颯": (14, "人名", "さつ そう はやて はや"),
+    "爽": (11, "常用", "そう さわ さや あきら"), "聡": (14, "人名", "そう さと さとし とし"), "早": (6, "常用", "そう さ はや さき"),
+    "草": (9, "常用", "そう くさ"), "蒼": (13, "人名", "そう あお あおい"), "奏": (9, "常用", "そう かな かなで"),
+    "湊": (12, "人名", "そう みなと"), "創": (12, "常用", "そう はじめ つくる"), "壮": (6, "常用", "そう たけ まさ"),
+    "朔": (10, "人名", "さく はじめ"), "大": (3, "常用", "だい たい おお ひろ まさ"), "太": (4, "常用", "た たい ふと"),
+    "拓": (8, "常用", "たく ひろ ひらく"), "卓": (8, "常用", "たく たか まさる"), "匠": (6, "常用", "しょう たくみ"),
+    "翔": (12, "人名", "しょう かける と しょ"), "正": (5, "常用", "せい しょう まさ ただし ただ"), "清": (11, "常用", "せい しょう きよ きよし すが"),
+    "誠": (13, "常用", "せい まこと まさ"), "晴": (12, "常用", "せい はる はれ"), "聖": (13, "常用", "せい しょう きよ ひじり"),
+    "星": (9, "常用", "せい しょう ほし"), "静": (14, "常用", "せい しず しずか"), "千": (3, "常用", "せん ち かず ゆき"),
+    "泉": (9, "常用", "せん いずみ みず"), "雪": (11, "常用", "せつ ゆき"), "詩": (13, "常用", "し うた"),
+    "志": (7, "常用", "し ゆき むね"), "史": (5, "常用", "し ふみ ちか"), "紫": (12, "常用", "し むらさき ゆかり"),
+    "司": (5, "常用", "し つかさ もり"), "慈": (13, "常用", "じ しげ ちか"), "実": (8, "常用", "じつ み みのる さね"),
+    "朱": (6, "常用", "しゅ あけ あや"), "珠": (10, "常用", "しゅ じゅ たま"), "秀": (7, "常用", "しゅう ひで"),
+    "周": (8, "常用", "しゅう あまね ちか"), "柊": (9, "人名", "しゅう ひいらぎ"), "俊": (9, "常用", "しゅん とし"),
+    "春": (9, "常用", "しゅん はる"), "駿": (17, "人名", "しゅん はやお とし"), "隼": (10, "人名", "しゅん じゅん はやと はやぶさ はや"),
+    "純": (10, "常用", "じゅん あつ すみ"), "淳": (11, "人名", "じゅん あつ あつし"), "順": (12, "常用", "じゅん のぶ より"),
+    "潤": (15, "常用", "じゅん うるう ひろ"), "初": (7, "常用", "しょ はつ うい"), "尚": (8, "常用", "しょう なお ひさ たか"),
+    "昌": (8, "人名", "しょう まさ あき"), "昭": (9, "常用", "しょう あき てる"), "祥": (10, "常用", "しょう さち よし"),
+    "笑": (10, "常用", "しょう えみ えむ"), "章": (11, "常用", "しょう あき ふみ"), "晶": (12, "常用", "しょう あき あきら"),
+    "樹": (16, "常用", "じゅ き いつき たつ"), "新": (13, "常用", "しん あら にい あらた"), "真": (10, "常用", "しん ま まこと まさ さな"),
+    "信": (9, "常用", "しん のぶ まこと"), "伸": (7, "常用", "しん のぶ"), "慎": (13, "常用", "しん まこと ちか"),
+    "仁": (4, "常用", "じん に ひと まさし"), "人": (2, "常用", "じん にん ひと と"), "翠": (14, "人名", "すい みどり"),
+    "瑞": (13, "人名", "ずい みず たま"), "澄": (15, "常用", "ちょう すみ きよ"), "泰": (10, "常用", "たい やす ひろ"),
+    "隆": (11, "常用", "りゅう たか たかし"), "達": (12, "常用", "たつ さと みち"), "智": (12, "人名", "ち とも さとし さと"),
+    "知": (8, "常用", "ち とも さと"), "暖": (13, "常用", "だん はる あたた"), "朝": (12, "常用", "ちょう あさ とも"),
+    "蝶": (15, "人名", "ちょう"), "直": (8, "常用", "ちょく じき なお ただ"), "月": (4, "常用", "げつ がつ つき"),
+    "椿": (13, "人名", "ちん つばき"), "紬": (11, "人名", "ちゅう つむぎ"), "天": (4, "常用", "てん あま たか そら"),
+    "典": (8, "常用", "てん のり すけ"), "冬": (5, "常用", "とう ふゆ"), "透": (10, "常用", "とう すき とおる ゆき"),
+    "桃": (10, "常用", "とう もも"), "瞳": (17, "常用", "どう ひとみ"), "徳": (14, "常用", "とく のり よし"),
+    "斗": (4, "常用", "と ます"), "登": (12, "常用", "と とう のぼる のり"), "奈": (8, "常用", "な だい"),
+    "菜": (11, "常用", "さい な"), "凪": (6, "人名", "なぎ"), "南": (9, "常用", "なん みなみ な"),
+    "日": (4, "常用", "にち じつ ひ か はる"), "乃": (2, "人名", "の だい ない"), "望": (11, "常用", "ぼう もう のぞみ のぞむ み"),
+    "博": (12, "常用", "はく ひろ ひろし"), "白": (5, "常用", "はく しろ あきら"), "帆": (6, "常用", "はん ほ"),
+    "陽": (12, "常用", "よう ひ はる ひなた あき"), "葉": (12, "常用", "よう は"), "洋": (9, "常用", "よう ひろ なみ"),
+    "遥": (12, "人名", "よう はるか はる"), "耀": (20, "人名", "よう あき てる"), "芳": (7, "常用", "ほう よし か かおる"),
+    "宝": (8, "常用", "ほう たから とみ"), "萌": (11, "人名", "ほう もえ めぐみ"), "朋": (8, "人名", "ほう とも"),
+    "峰": (10, "常用", "ほう みね"), "穂": (15, "常用", "すい ほ みのる"), "舞": (15, "常用", "ぶ まい"),
+    "文": (4, "常用", "ぶん もん ふみ あや"), "歩": (8, "常用", "ほ ぶ あゆむ あゆ"), "麻": (11, "常用", "ま あさ"),
+    "万": (3, "常用", "まん ばん かず"), "満": (12, "常用", "まん みつ みちる"), "美": (9, "常用", "び み よし"),
+    "未": (5, "常用", "み いまだ"), "明": (8, "常用", "めい みょう あき あきら あかり はる"), "芽": (8, "常用", "が め"),
+    "結": (12, "常用", "けつ ゆい ゆう ゆ むすぶ"), "唯": (11, "常用", "ゆい い"), "悠": (11, "常用", "ゆう はるか ひさ はる"),
+    "優": (17, "常用", "ゆう まさる ひろ やさ"), "友": (4, "常用", "ゆう とも"), "勇": (9, "常用", "ゆう いさむ いさ"),
+    "裕": (12, "常用", "ゆう ひろ ひろし"), "雄": (12, "常用", "ゆう お たけ"), "佑": (7, "人名", "ゆう すけ たすく"),
+    "祐": (9, "人名", "ゆう すけ さち"), "柚": (9, "人名", "ゆ ゆず"), "由": (5, "常用", "ゆ ゆう よし"),
+    "夢": (13, "常用", "む ゆめ"), "蘭": (19, "人名", "らん"), "莉": (10, "人名", "り"),
+    "里": (7, "常用", "り さと"), "理": (11, "常用", "り さと まさ"), "璃": (15, "人名", "り"),
+    "律": (9, "常用", "りつ のり"), "陸": (11, "常用", "りく む"), "琉": (11, "人名", "る りゅう"),
+    "竜": (10, "常用", "りゅう たつ"), "龍": (16, "人名", "りゅう たつ"), "涼": (11, "常用", "りょう すず"),
+    "遼": (15, "人名", "りょう はるか"), "亮": (9, "人名", "りょう あきら すけ"), "良": (7, "常用", "りょう よし ら"),
+    "稜": (13, "人名", "りょう"), "凛": (15, "人名", "りん"), "凜": (15, "人名", "りん"),
+    "鈴": (13, "常用", "れい りん すず"), "麟": (24, "人名", "りん"), "玲": (9, "人名", "れい りょう たま"),
+    "礼": (5, "常用", "れい らい あや のり"), "怜": (8, "人名", "れい さと とき"), "蓮": (13, "人名", "れん はす"),
+    "恋": (10, "常用", "れん こい"), "廉": (13, "常用", "れん きよ やす"), "和": (8, "常用", "わ かず なごみ やまと より"),
+    "子": (3, "常用", "し す こ ね"), "郎": (9, "常用", "ろう お"), "介": (4, "常用", "かい すけ"),
+    "助": (7, "常用", "じょ すけ"), "輔": (14, "人名", "ほ すけ たすく"), "也": (3, "人名", "や なり"),
+    "哉": (9, "人名", "さい や かな とし"), "弥": (8, "常用", "び み や ひろ わたる"), "生": (5, "常用", "せい しょう い お き なり"),
+    "男": (7, "常用", "だん なん お"), "雅": (13, "常用", "が まさ みやび"), "悟": (10, "常用", "ご さとる さと"),
+    "碧": (14, "人名", "へき あお みどり"), "暁": (12, "常用", "ぎょう あき さとる"), "絆": (11, "人名", "はん きずな"),
+    "丈": (3, "常用", "じょう たけ"), "楽": (13, "常用", "がく らく ら たの"), "鷹": (24, "人名", "よう たか"),
+    # 名前には避けられることが多い漢字（画数や読みの判定のために収録）
+    "悪": (11, "常用", "あく お わる"), "死": (6, "常用", "し"), "病": (10, "常用", "びょう やまい"),
+    "苦": (8, "常用", "く にが"), "貧": (11, "常用", "ひん びん まず"), "鬼": (10, "常用", "き おに"),
+    "魔": (21, "常用", "ま"), "殺": (10, "常用", "さつ ころ"), "毒": (8, "常用", "どく"),
+    "血": (6, "常用", "けつ ち"), "呪": (8, "常用", "じゅ のろ"), "痛": (12, "常用", "つう いた"),
+    "哀": (9, "常用", "あい あわ"), "闇": (17, "常用", "あん やみ"), "憎": (14, "常用", "ぞう にく"),
+    # 旧字体（人名用漢字として名前に使える異体字）
+    "櫻": (21, "人名", "おう さくら"), "眞": (10, "人名", "しん ま まこと まさ さな"), "惠": (12, "人名", "けい え めぐみ めぐ"),
+    "廣": (15, "人名", "こう ひろ ひろし"), "國": (11, "人名", "こく くに"), "穗": (17, "人名", "すい ほ みのる"),
+    "凉": (10, "人名", "りょう すず"), "亞": (8, "人名", "あ つぐ"), "來": (8, "人名", "らい く き"),
+    "壽": (14, "人名", "じゅ ひさ とし"), "德": (15, "人名", "とく のり よし"), "樂": (15, "人名", "がく らく ら たの"),
+    "禮": (18, "人名", "れい らい あや のり"), "彌": (17, "人名", "び み や ひろ わたる"), "曉": (16, "人名", "ぎょう あき さとる"),
+    "榮": (14, "人名", "えい さかえ はる ひで よし"), "實": (14, "人名", "じつ み みのる さね"), "遙": (14, "人名", "よう はるか はる"),
+    # 名前に使いたいという要望が多いが、常用漢字でも人名用漢字でもない漢字（人の名前には使えない）
+    "薔": (16, "表外", "しょう そう ばら"), "薇": (16, "表外", "び ばら"), "檸": (18, "表外", "ねい"),
+    "檬": (17, "表外", "もう"), "瑪": (14, "表外", "め ば"), "瑙": (13, "表外", "のう"), "翡": (14, "表外", "ひ"),
+}
+REGISTRABLE_CATEGORIES = {"常用", "人名"}  # 人の名前（出生届）に使える区分
+
+# 「々」は直前の漢字を繰り返す記号として扱う
+ITERATION_MARK = "々"
+
+# =====================================================================
+# かなの表
+# =====================================================================
+SMALL_KANA = set("ゃゅょぁぃぅぇぉゎ")  # 前の文字と合わせて1音になる小さい文字
+
+# ひらがな1文字 → ローマ字（ヘボン式）
+KANA_ROMAJI = {
+    "あ": "a", "い": "i", "う": "u", "え": "e", "お": "o",
+    "か": "ka", "き": "ki", "く": "ku", "け": "ke", "こ": "ko", "が": "ga", "ぎ": "gi", "ぐ": "gu", "げ": "ge", "ご": "go",
+    "さ": "sa", "し": "shi", "す": "su", "せ": "se", "そ": "so", "ざ": "za", "じ": "ji", "ず": "zu", "ぜ": "ze", "ぞ": "zo",
+    "た": "ta", "ち": "chi", "つ": "tsu", "て": "te", "と": "to", "だ": "da", "ぢ": "ji", "づ": "zu", "で": "de", "ど": "do",
+    "な": "na", "に": "ni", "ぬ": "nu", "ね": "ne", "の": "no",
+    "は": "ha", "ひ": "hi", "ふ": "fu", "へ": "he", "ほ": "ho", "ば": "ba", "び": "bi", "ぶ": "bu", "べ": "be", "ぼ": "bo",
+    "ぱ": "pa", "ぴ": "pi", "ぷ": "pu", "ぺ": "pe", "ぽ": "po",
+    "ま": "ma", "み": "mi", "む": "mu", "め": "me", "も": "mo",
+    "や": "ya", "ゆ": "yu", "よ": "yo", "ら": "ra", "り": "ri", "る": "ru", "れ": "re", "ろ": "ro",
+    "わ": "wa", "ゐ": "i", "ゑ": "e", "を": "o", "ん": "n", "ゔ": "vu",
+    "ぁ": "a", "ぃ": "i", "ぅ": "u", "ぇ": "e", "ぉ": "o", "ゃ": "ya", "ゅ": "yu", "ょ": "yo", "ゎ": "wa",
+}
+
+# 小さい文字と組み合わせた音（例：しゃ → sha、ふぁ → fa）
+KANA_ROMAJI_COMBINED = {
+    "しゃ": "sha", "しゅ": "shu", "しぇ": "she", "しょ": "sho", "じゃ": "ja", "じゅ": "ju", "じぇ": "je", "じょ": "jo",
+    "ちゃ": "cha", "ちゅ": "chu", "ちぇ": "che", "ちょ": "cho", "ぢゃ": "ja", "ぢゅ": "ju", "ぢょ": "jo",
+    "ふぁ": "fa", "ふぃ": "fi", "ふぇ": "fe", "ふぉ": "fo", "てぃ": "ti", "でぃ": "di", "とぅ": "tu", "どぅ": "du",
+    "うぃ": "wi", "うぇ": "we", "うぉ": "wo", "ゔぁ": "va", "ゔぃ": "vi", "ゔぇ": "ve", "ゔぉ": "vo", "つぁ": "tsa",
+}
+
+# 清音 → 濁音・半濁音（「はる」+「ひ」→「はるび」のような連濁を読みとして認めるため）
+VOICED_KANA = {
+    "か": "が", "き": "ぎ", "く": "ぐ", "け": "げ", "こ": "ご", "さ": "ざ", "し": "じ", "す": "ず", "せ": "ぜ", "そ": "ぞ",
+    "た": "だ", "ち": "ぢ", "つ": "づ", "て": "で", "と": "ど", "は": "ば", "ひ": "び", "ふ": "ぶ", "へ": "べ", "ほ": "ぼ",
+}
+
+# =====================================================================
+# 他言語で悪い意味・音になる語の辞書
+# 日本語の読みをローマ字にしたときの綴りで登録する（例：スペイン語の culo は「くろ」→ kuro）
+# (ローマ字, 言語, 意味, リスク, 一致のしかた)  一致のしかた：exact=読み全体が一致、contains=読みの一部に含む
+# 短い語は偶然含まれやすいので、読み全体が一致したときだけ判定する。
+# 部分一致の語も音の区切りで一致したときだけ判定する（「じゅんこ」の junko は「う・ん・こ」ではないので unko には当たらない）
+# =====================================================================
+BAD_WORD_LEXICON = [
+    ("unko", "日本語", "大便（幼児語）", "高", "contains"), ("chinko", "日本語", "男性器（俗語）", "高", "contains"),
+    ("manko", "日本語", "女性器（俗語）", "高", "contains"), ("chinchin", "日本語", "男性器（幼児語）", "高", "contains"),
+    ("kuso", "日本語", "大便・罵り言葉", "高", "exact"), ("shine", "日本語", "「死ね」と読める", "高", "exact"),
+    ("baka", "日本語", "罵り言葉", "高", "exact"), ("aho", "日本語", "罵り言葉", "中", "exact"),
+    ("sekkusu", "英語", "sex（性行為）", "高", "contains"), ("sekusu", "英語", "sex（性行為）", "高", "contains"),
+    ("anaru", "英語", "anal（性的な語）", "高", "exact"), ("poruno", "英語", "porn（ポルノ）", "高", "contains"),
+    ("penisu", "英語", "penis（男性器）", "高", "contains"), ("fakku", "英語", "fuck（罵り言葉）", "高", "contains"),
+    ("fuku", "英語", "fuck に近い音", "中", "exact"), ("shitto", "英語", "shit（罵り言葉）", "高", "exact"),
+    ("pisu", "英語", "piss（小便）", "中", "exact"), ("kiru", "英語", "kill（殺す）に近い音", "低", "exact"),
+    ("dai", "英語", "die（死ぬ）に近い音", "低", "exact"), ("heru", "英語", "hell（地獄）に近い音", "低", "exact"),
+    ("puta", "スペイン語", "売春婦（罵り言葉）", "高", "contains"), ("pajero", "スペイン語", "自慰をする人（俗語）", "高", "contains"),
+    ("pito", "スペイン語", "男性器（俗語）", "中", "exact"), ("chocho", "スペイン語", "女性器（俗語）", "高", "exact"),
+    ("konyo", "スペイン語", "coño（女性器・罵り言葉）", "高", "exact"), ("kuro", "スペイン語", "culo（尻）に近い音", "低", "exact"),
+    ("kaka", "スペイン語・ポルトガル語・ギリシャ語", "大便（幼児語）", "中", "exact"), ("poto", "スペイン語（チリ）", "尻（俗語）", "中", "exact"),
+    ("bunda", "ポルトガル語", "尻（俗語）", "中", "exact"), ("pora", "ポルトガル語", "porra（罵り言葉）", "中", "exact"),
+    ("kon", "フランス語", "con（ばか・女性器の俗語）", "中", "exact"), ("merudo", "フランス語", "merde（大便）", "高", "exact"),
+    ("pyutto", "フランス語", "pute（売春婦）", "中", "exact"), ("figa", "イタリア語", "女性器（俗語）", "高", "exact"),
+    ("kakke", "ドイツ語", "Kacke（大便）", "中", "exact"), ("kusu", "アラビア語", "女性器（俗語）", "中", "exact"),
+    ("babo", "韓国語", "ばか", "中", "exact"), ("shibaru", "韓国語", "罵り言葉（시발）に近い音", "中", "exact"),
+    ("shabi", "中国語", "傻逼（罵り言葉）", "高", "exact"),
+]
+
+RISK_ORDER = {"低": 1, "中": 2, "高": 3}
+
+# 読みのローマ字 → 登録語 の索引（読み全体での一致はここを引くだけで済む）
+EXACT_INDEX = {}
+# 部分一致の語は長さごとにまとめておき、読みの同じ長さの部分だけを引く
+CONTAINS_INDEX = {}
+for entry in BAD_WORD_LEXICON:
+    word, match = entry[0], entry[4]
+    EXACT_INDEX.setdefault(word, []).append(entry)
+    if match == "contains":
+        CONTAINS_INDEX.setdefault(len(word), {}).setdefault(word, []).append(entry)
+
+
+def to_hiragana(text):
+    # 全角・半角を揃え、カタカナをひらがなにする（長音「ー」はそのまま残す）
+    text = unicodedata.normalize("NFKC", text or "").replace(" ", "").replace("　", "")
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+
+def split_mora(yomi):
+    # 読みを1音（拍）ずつに分ける。「しゃ」は1音、「っ」「ん」「ー」はそれぞれ1音
+    mora = []
+    for c in to_hiragana(yomi):
+        if c in SMALL_KANA and mora:
+            mora[-1] += c
+        else:
+            mora.append(c)
+    return mora
+
+
+def to_romaji(yomi):
+    romaji = ""
+    double_next = False  # 「っ」の次の子音を重ねる
+    for m in split_mora(yomi):
+        if m == "っ":
+            double_next = True
+            continue
+        if m == "ー":
+            romaji += next((c for c in reversed(romaji) if c in "aiueo"), "")
+            continue
+        part = KANA_ROMAJI_COMBINED.get(m)
+        if part is None:
+            part = "".join(KANA_ROMAJI.get(c, "") for c in m)
+            if len(m) == 2 and m[1] in "ゃゅょ" and len(part) >= 4:
+                part = part[:-3] + part[-2:]  # 「きゃ」→ kiya ではなく kya
+        if double_next and part:
+            part = ("t" if part.startswith("ch") else part[0]) + part
+        double_next = False
+        romaji += part
+    return romaji
+
+
+def vowel_pattern(yomi):
+    # 1音ごとの母音（a/i/u/e/o）、撥音は N、促音は Q で表す
+    pattern = []
+    for m in split_mora(yomi):
+        if m == "ん":
+            pattern.append("N")
+        elif m == "っ":
+            pattern.append("Q")
+        elif m == "ー":
+            pattern.append(pattern[-1] if pattern else "")
+        else:
+            romaji = to_romaji(m)
+            pattern.append(romaji[-1] if romaji and romaji[-1] in "aiueo" else "")
+    return "".join(pattern)
+
+
+def mora_boundaries(yomi):
+    # ローマ字の中で、音（拍）の区切りにあたる位置の集合を返す
+    mora = split_mora(yomi)
+    return {len(to_romaji("".join(mora[:i]))) for i in range(len(mora) + 1)}
+
+
+def find_bad_words(yomi):
+    # 読みが他言語で悪い意味・音になる語に当たるかを調べ、見つかった語の一覧を返す
+    romaji = to_romaji(yomi)
+    found = list(EXACT_INDEX.get(romaji, []))
+    boundaries = mora_boundaries(yomi)
+    for length, words in CONTAINS_INDEX.items():
+        for start in sorted(boundaries):
+            if start + length not in boundaries:
+                continue
+            for entry in words.get(romaji[start:start + length], []):
+                if entry not in found:
+                    found.append(entry)
+    return [
+        {"word": word, "language": language, "meaning": meaning, "risk": risk}
+        for word, language, meaning, risk, _ in found
+    ]
+
+
+def expand_kanji(name):
+    # 「々」を直前の漢字に置き換えた文字の並びを返す
+    chars = []
+    for c in name:
+        chars.append(chars[-1] if c == ITERATION_MARK and chars else c)
+    return chars
+
+
+def is_kanji(c):
+    return "一" <= c <= "鿿" or "㐀" <= c <= "䶿" or "豈" <= c <= "﫿"
+
+
+def kanji_readings(c):
+    # 漢字の読みの一覧（連濁した読みも含める）
+    readings = set(KANJI_TABLE[c][2].split())
+    readings |= {VOICED_KANA[r[0]] + r[1:] for r in readings if r[0] in VOICED_KANA}
+    return readings
+
+
+def can_read_as(chars, yomi):
+    # 名前の各文字の読みをつなげて、読み仮名どおりに読めるかを調べる（当て字なら False）
+    if not chars:
+        return yomi == ""
+    c = chars[0]
+    if not is_kanji(c):
+        c = to_hiragana(c)
+        return yomi.startswith(c) and can_read_as(chars[1:], yomi[len(c):])
+    for reading in kanji_readings(c):
+        # 「いち」+「か」→「いっか」のような促音化も認める
+        for form in {reading, reading[:-1] + "っ"}:
+            if form and yomi.startswith(form) and can_read_as(chars[1:], yomi[len(form):]):
+                return True
+    return False
+
+
+def score_hibiki(yomi):
+    # 音の数と母音の並びから響きの目安を出す
+    mora_count = len(split_mora(yomi))
+    score = {1: 70, 2: 90, 3: 100, 4: 95, 5: 85}.get(mora_count, 70)
+    vowels = vowel_pattern(yomi)
+    if len(vowels) >= 3 and len(set(vowels)) == 1:
+        score -= 10  # 同じ母音ばかりで単調
+    voiced = sum(1 for c in to_hiragana(yomi) if c in VOICED_KANA.values() or c in "ぱぴぷぺぽ")
+    if mora_count and voiced * 2 > mora_count:
+        score -= 10  # 濁音・半濁音が多く硬い印象
+    return max(score, 0)
+
+
+def score_jikei(strokes):
+    # 各漢字の画数のバランスから字形の目安を出す（漢字を含まない名前は None）
+    if not strokes:
+        return None
+    score = 100
+    score -= 10 * sum(1 for s in strokes if s >= 20)  # 画数が多すぎて書きにくい字
+    if sum(strokes) > 40:
+        score -= 10
+    if len(strokes) >= 2 and max(strokes) - min(strokes) > 12:
+        score -= 10  # 画数の差が大きく、並べたときに偏って見える
+    if len(strokes) >= 2 and max(strokes) <= 3:
+        score -= 10  # 画数が少なすぎて軽く見える
+    return max(score, 0)
+
+
+def check_length_tags(name, tags):
+    # 「2文字」「3文字」タグと実際の文字数が合っているかを調べ、合わないタグの一覧を返す
+    length = len(unicodedata.normalize("NFKC", name).replace(" ", ""))
+    return [tag for tag, expected in (("2文字", 2), ("3文字", 3)) if tag in (tags or []) and length != expected]
+
+
+def local_scores(name, yomi, tags=None):
+    # APIを使わずに計算できる指標をまとめて返す
+    chars = expand_kanji(unicodedata.normalize("NFKC", name).replace(" ", ""))
+    spelled = [c for c in chars if c != "ー"]  # 長音は読みの照合から除く
+    kanji = [c for c in chars if is_kanji(c)]
+    unknown_kanji = sorted({c for c in kanji if c not in KANJI_TABLE})
+    unregistrable_kanji = sorted({c for c in kanji if c in KANJI_TABLE and KANJI_TABLE[c][1] not in REGISTRABLE_CATEGORIES})
+    strokes = [KANJI_TABLE[c][0] for c in kanji if c in KANJI_TABLE]
+    hiragana_yomi = to_hiragana(yomi).replace("ー", "")
+
+    if unknown_kanji:
+        kadoku = None  # 読みが分からない漢字があるので判定しない
+    elif can_read_as(spelled, hiragana_yomi):
+        kadoku = 100
+    else:
+        kadoku = 60  # 当て字・難読
+
+    bad_words = find_bad_words(yomi)
+    risk_level = max((w["risk"] for w in bad_words), key=RISK_ORDER.get, default="低")
+    return {
+        "char_count": len(chars),
+        "mora_count": len(split_mora(yomi)),
+        "vowels": vowel_pattern(yomi),
+        "romaji": to_romaji(yomi),
+        "strokes": sum(strokes) if strokes and not unknown_kanji else None,
+        "unknown_kanji": unknown_kanji,
+        "unregistrable_kanji": unregistrable_kanji,  # 人の名前には使えない漢字
+        "hibiki": score_hibiki(yomi),
+        "jikei": None if unknown_kanji else score_jikei(strokes),
+        "kadoku": kadoku,
+        "bad_words": bad_words,
+        "risk_level": risk_level,
+        "tag_mismatches": check_length_tags(name, tags),
+    }
+
+
+# =====================================================================
+# 漢字の条件チェック（使いたい漢字・避けたい漢字）
+# 新字体と旧字体・異体字は同じ漢字として扱う（「桜」を避けたいなら「櫻」も避ける）。
+# 互換漢字（見た目が同じで文字コードだけ違う字）は NFKC 正規化で揃える
+# =====================================================================
+KANJI_VARIANT_GROUPS = [
+    "桜櫻", "真眞", "恵惠", "広廣", "国國", "穂穗", "涼凉", "亜亞", "来來", "寿壽", "徳德", "楽樂", "礼禮",
+    "弥彌", "暁曉", "栄榮", "実實", "遥遙", "竜龍", "凛凜", "沢澤", "浜濱", "斉齊斎齋", "辺邊邉", "島嶋嶌",
+    "崎﨑嵜", "高髙", "吉𠮷", "剣劍剱", "黒黑", "恋戀", "蛍螢", "鉄鐵", "悪惡", "万萬", "円圓", "会會",
+    "学學", "気氣", "児兒", "晋晉", "瑶瑤",
+]
+
+# 漢字 → 同じ漢字として扱う字の集合
+VARIANT_INDEX = {}
+for group in KANJI_VARIANT_GROUPS:
+    group = set(group) | {unicodedata.normalize("NFKC", c) for c in group}
+    for c in group:
+        VARIANT_INDEX[c] = group
+
+
+def kanji_variants(c):
+    return VARIANT_INDEX.get(c, {c})
+
+
+def contains_word(name, yomi, word):
+    # かなだけの語は読みに含まれるか、漢字を含む語は（異体字も含めて）表記に含まれるかを調べる
+    if not any(is_kanji(c) for c in word):
+        return to_hiragana(word) in to_hiragana(yomi) or to_hiragana(word) in to_hiragana(name)
+    for start in range(len(name) - len(word) + 1):
+        if all(name[start + i] in kanji_variants(c) for i, c in enumerate(word)):
+            return True
+    return False
+
+
+def check_kanji_constraints(name, yomi, use_list, avoid_list):
+    # 条件に合わない理由の一覧を返す（空なら条件どおり）。
+    # 「使いたい漢字」はどれか1つでも入っていればよく、「避けたい漢字」は1つも入っていてはいけない
+    name = "".join(expand_kanji(unicodedata.normalize("NFKC", name).replace(" ", "")))
+    problems = [f"避けたい「{word}」を含む" for word in avoid_list if contains_word(name, yomi, word)]
+    if use_list and not any(contains_word(name, yomi, word) for word in use_list):
+        problems.append(f"使いたい「{'・'.join(use_list)}」をどれも含まない")
+    return problems
@@ -0,0 +1,59 @@
+from name_scoring import check_kanji_constraints, contains_word, find_bad_words, kanji_variants, local_scores
+
+
+def words(yomi):
+    return [w["word"] for w in find_bad_words(yomi)]
+
+
+def test_contains_words_match_only_on_mora_boundaries():
+    # junko の中の unko は「じゅ・ん・こ」の区切りとずれているので当たらない
+    assert words("じゅんこ") == []
+    assert words("ジュンコ") == []
+    assert words("しゅんこ") == []
+    assert words("うんこ") == ["unko"]
+    assert words("せっくす") == ["sekkusu"]
+
+
+def test_common_names_are_not_high_risk():
+    for name, yomi in [("純子", "じゅんこ"), ("順子", "じゅんこ"), ("淳子", "じゅんこ"), ("春子", "しゅんこ")]:
+        assert local_scores(name, yomi)["risk_level"] == "低"
+    # よくある読みを特別扱いしなくても、モーラの区切りの判定だけで当たらない
+    for yomi in ["じゅんこう", "しゅんこう", "きんこ", "ぎんこ", "ゆき"]:
+        assert words(yomi) == []
+
+
+def test_unregistrable_kanji_are_reported():
+    assert local_scores("薔薇", "ばら")["unregistrable_kanji"] == ["薇", "薔"]
+    assert local_scores("陽菜", "ひな")["unregistrable_kanji"] == []
+
+
+def test_kanji_variants_include_old_forms():
+    assert kanji_variants("桜") == {"桜", "櫻"}
+    assert kanji_variants("櫻") == {"桜", "櫻"}
+    assert kanji_variants("々") == {"々"}
+
+
+def test_contains_word_checks_reading_for_kana_and_spelling_for_kanji():
+    # かなの語は読みでも表記でも（ひらがな・カタカナを問わず）当たる
+    assert contains_word("陽向", "ひなた", "ヒナ")
+    assert contains_word("ひなた", "ひなた", "ひな")
+    assert not contains_word("陽向", "ひなた", "さくら")
+    # 漢字の語は表記だけを見て、異体字も同じ字として扱う
+    assert contains_word("櫻子", "さくらこ", "桜")
+    assert not contains_word("咲良", "さくら", "桜")
+
+
+def test_check_kanji_constraints_use_any_avoid_all():
+    # 「使いたい漢字」はどれか1つ入っていればよい
+    assert check_kanji_constraints("陽菜", "ひな", ["陽", "結"], []) == []
+    assert check_kanji_constraints("美桜", "みお", ["陽", "結"], []) == ["使いたい「陽・結」をどれも含まない"]
+    # 「避けたい漢字」は1つずつ全部調べる
+    assert check_kanji_constraints("陽結", "ひゆ", [], ["陽", "結"]) == ["避けたい「陽」を含む", "避けたい「結」を含む"]
+    assert check_kanji_constraints("櫻子", "さくらこ", [], ["桜"]) == ["避けたい「桜」を含む"]
+    assert check_kanji_constraints("ひかり", "ひかり", ["ひかり"], []) == []
+
+
+def test_check_kanji_constraints_expands_iteration_mark():
+    # 「菜々」は「菜菜」として調べる
+    assert check_kanji_constraints("菜々", "なな", [], ["菜"]) == ["避けたい「菜」を含む"]
+    assert check_kanji_constraints("菜々", "なな", ["菜菜"], []) == []